@@ -0,0 +1,200 @@
+import random
+from collections import deque
+from functools import partial
+
+from papers.csp.controller import Controller, LeanNetwork, SequentialDispatcher, NaiveNetwork
+from papers.csp.exercises import Ex46Runner, Set46Worker, FailProcess
+from papers.csp.io_semantics import InputGuard, OutputGuard, TimeoutGuard, CommandFailure
+from papers.csp.process import Process, AwaitInput
+
+
+class Port(Process):
+    # Stands inside a composite for one process outside it, so the subnetwork is wired to the port as it would be
+    # to that process. Values from outside are offered to the port's receivers, whichever takes them first, and
+    # values from its senders are passed out in the order they arrive. The port holds one value each way, so an
+    # inner send to the outside completes once the port has taken it rather than when the outer process does.
+    def __init__(self, controller, outer_process):
+        super(Port, self).__init__(controller)
+        self._outer_process = outer_process
+        self._senders = []
+        self._receivers = []
+        self._inbox = deque()
+        self._outbox = deque()
+        # Never fires by itself: the composite interrupts it whenever the inbox or outbox has changed, so the port
+        # can take stock
+        self._doorbell = TimeoutGuard(None)
+        self._closed = False
+
+    @property
+    def outer_process(self):
+        return self._outer_process
+
+    def add_sender(self, process):
+        self._senders.append(process)
+        self.register_inputs(process)
+
+    def add_receiver(self, process):
+        self._receivers.append(process)
+        self.register_outputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return bool(self._senders) or bool(self._receivers)
+
+    @property
+    def incoming(self):
+        return self._inbox
+
+    @property
+    def outgoing(self):
+        return self._outbox
+
+    def pass_in(self, value):
+        self._inbox.append(value)
+        self.ring()
+
+    def passed_out(self):
+        self._outbox.popleft()
+        self.ring()
+
+    def ring(self):
+        self._controller.network.interrupt(self, self._doorbell)
+
+    def close(self):
+        self._closed = True
+        self.ring()
+
+    def _run(self):
+        def delivered(_):
+            self._inbox.popleft()
+
+        def collected(value):
+            self._outbox.append(value)
+
+        def rang(_):
+            pass
+
+        while not self._closed:
+            guarded_matches = {self._doorbell: rang}
+            if self._inbox:
+                for receiver in self._receivers:
+                    guarded_matches[OutputGuard(receiver, self._inbox[0])] = delivered
+            if not self._outbox:
+                for sender in self._senders:
+                    guarded_matches[InputGuard(sender)] = collected
+            yield self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+
+
+class CompositeProcess(Process):
+    # A subnetwork run as a single process of its parent network. Its processes are created on inner_controller,
+    # which has its own network and dispatcher, and reach the outside through ports; only the composite's channels
+    # to the processes behind its ports are seen by the parent. Each time the composite is resumed it runs the
+    # subnetwork until every inner process is blocked or finished, then offers the parent what its ports hold.
+    # Composites trade speed for encapsulation: every value crossing the boundary costs a port step and a turn of
+    # the composite's alternation on top of the rendezvous the flat network would make, so a composite runs slower
+    # than the same processes wired flat. And because ports buffer, a send across the boundary, either way, completes
+    # when the port takes it rather than when the process on the other side does, so a network that relies on that
+    # rendezvous as an acknowledgement should not be split at that channel.
+    def __init__(self, controller, network_class=LeanNetwork, dispatcher_class=SequentialDispatcher):
+        super(CompositeProcess, self).__init__(controller)
+        self._inner_controller = Controller()
+        network_class(self._inner_controller)
+        dispatcher_class(self._inner_controller)
+        self._ports = []
+
+    @property
+    def inner_controller(self):
+        return self._inner_controller
+
+    def port(self, outer_process):
+        # The outer process must itself be wired to the composite both ways
+        port = Port(self._inner_controller, outer_process)
+        self._ports.append(port)
+        self.register_inputs(outer_process)
+        self.register_outputs(outer_process)
+        return port
+
+    @property
+    def _is_run_ready(self):
+        return bool(self._ports)
+
+    def _settle(self):
+        while self._inner_controller.step():
+            pass
+
+    def _inner_active(self):
+        return any(process not in self._ports for process in self._inner_controller.active_processes)
+
+    def _run(self):
+        self._inner_controller.wire()
+
+        def received(port, value):
+            port.pass_in(value)
+
+        def sent(port, _):
+            port.passed_out()
+
+        while True:
+            self._settle()
+            if not self._inner_active():
+                break
+            guarded_matches = {}
+            for port in self._ports:
+                if port.outgoing:
+                    guarded_matches[OutputGuard(port.outer_process, port.outgoing[0])] = partial(sent, port)
+                if not port.incoming:
+                    guarded_matches[InputGuard(port.outer_process)] = partial(received, port)
+            if not any(guard.viable for guard in guarded_matches):
+                break
+            try:
+                yield self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+            except CommandFailure:
+                break
+
+        # Inner processes still waiting on the outside see it go, as they would the processes behind the ports
+        for port in self._ports:
+            port.close()
+        self._settle()
+
+
+def build_composite_ex_4_6(controller, inputs, size=100):
+    # build_ex_4_6 with the worker chain inside a composite, which the runner sees as a single set worker
+    runner = Ex46Runner(controller, inputs)
+    composite = CompositeProcess(controller)
+    runner.set_receiver_process(composite)
+    runner.add_response_process(composite)
+
+    inner = composite.inner_controller
+    port = composite.port(runner)
+    previous = port
+    for i in range(size):
+        worker = Set46Worker(inner)
+        worker.set_previous_process(previous)
+        if i == 0:
+            port.add_receiver(worker)
+        else:
+            previous.set_next_process(worker)
+        port.add_sender(worker)
+        worker.set_originating_process(port)
+        previous = worker
+
+    fail = FailProcess(inner)
+    previous.set_next_process(fail)
+    fail.add_input_process(previous)
+    fail.register_outputs(previous)
+    return composite
+
+
+def ex_4_6_composite():
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    inputs = random.sample(range(1000), 32)
+    composite = build_composite_ex_4_6(controller, inputs)
+
+    controller.wire()
+    controller.run()
+
+    print('Ran to completion: {} steps outside the composite, {} inside'.format(
+        controller.steps, composite.inner_controller.steps))
@@ -1,9 +1,23 @@
+import heapq
 import random
 import sys
+import time
 from collections import defaultdict
+from itertools import count
 
-from papers.csp.io_semantics import CommandFailure
-from papers.csp.process import AwaitInput, AwaitOutput, AwaitInit
+from papers.csp.io_semantics import CommandFailure, OutputGuard, TimeoutGuard, form_matches
+from papers.csp.network_builder import CsrAdjacency
+from papers.csp.offload import run_inline
+from papers.csp.process import AwaitInput, AwaitOutput, AwaitInit, AwaitCompute, AwaitIo
+from papers.csp.schema import Schema
+
+
+# What a process is doing in a network snapshot. Waiting covers whatever the network does not hold it for:
+# computations, file descriptors, or being run at that moment.
+READY = 'ready'
+BLOCKED_INPUT = 'blocked on input'
+BLOCKED_OUTPUT = 'blocked on output'
+WAITING = 'waiting'
 
 
 class DeadlockError(Exception):
@@ -19,8 +33,14 @@ class SequentialDispatcher(object):
     def processes_running(self):
         return False
 
+    def _choose(self, ready_awaits):
+        return random.choice(list(ready_awaits))
+
     def run_one(self, ready_awaits):
-        await_ = random.choice(list(ready_awaits))
+        return self.resume(self._choose(ready_awaits))
+
+    def resume(self, await_):
+        # Runs the process behind await_, which must be ready, without making a choice
         process = await_.origin_process
         runner = self._controller.process_runner(process)
         self._controller.remove_ready(await_.origin_process)
@@ -44,7 +64,97 @@ class SequentialDispatcher(object):
         return self.run_one(ready_processes)
 
 
-class NaiveNetwork(object):
+def _distances(starts, neighbours):
+    # Breadth first hop counts from the nearest of starts
+    distances = {process: 0 for process in starts}
+    frontier = list(starts)
+    while frontier:
+        next_frontier = []
+        for process in frontier:
+            for neighbour in neighbours[process]:
+                if neighbour not in distances:
+                    distances[neighbour] = distances[process] + 1
+                    next_frontier.append(neighbour)
+        frontier = next_frontier
+    return distances
+
+
+class _ReadyBucket(object):
+    # The ready awaits of one rank, in a list for picking at random and indexed by process for removal
+    __slots__ = ('awaits', 'positions')
+
+    def __init__(self):
+        self.awaits = []
+        self.positions = {}
+
+    def add(self, await_):
+        self.positions[await_.origin_process] = len(self.awaits)
+        self.awaits.append(await_)
+
+    def remove(self, process):
+        position = self.positions.pop(process)
+        last = self.awaits.pop()
+        if position < len(self.awaits):
+            self.awaits[position] = last
+            self.positions[last.origin_process] = position
+
+
+class DataflowDispatcher(SequentialDispatcher):
+    # Resumes the ready process nearest a sink, and of those the one furthest from a source, so values already in a
+    # pipeline are drained before more are let in and fewer senders sit blocked. Ties are broken at random. The
+    # distances are taken from the wiring the first time a process is run; a graph without sinks or sources, such
+    # as callers and workers wired both ways, gives no preference. From then on the network reports every change
+    # to its ready set, which is kept in buckets by rank with a heap of the ranks that have any, so a choice costs
+    # O(log ranks) rather than a scan of everything ready.
+    def __init__(self, controller):
+        super(DataflowDispatcher, self).__init__(controller)
+        self._ranks = None
+        self._buckets = {}
+        # Every rank with a bucket is in the heap once; emptied buckets are dropped when they reach the top
+        self._heap = []
+
+    def _rank_processes(self):
+        network = self._controller.network
+        processes = network.active_processes
+        outputs = {process: list(network.outputs_of(process)) for process in processes}
+        inputs = {process: [] for process in processes}
+        for process, receivers in outputs.iteritems():
+            for receiver in receivers:
+                inputs[receiver].append(process)
+
+        to_sink = _distances([process for process in processes if not outputs[process]], inputs)
+        from_source = _distances([process for process in processes if not inputs[process]], outputs)
+        # Nearness to a sink first, then distance from a source, as one int to keep comparisons cheap
+        unreachable = len(processes)
+        return {process: to_sink.get(process, unreachable) * (unreachable + 1) + unreachable -
+                from_source.get(process, 0) for process in processes}
+
+    def ready_added(self, await_):
+        rank = self._ranks[await_.origin_process]
+        bucket = self._buckets.get(rank)
+        if bucket is None:
+            bucket = self._buckets[rank] = _ReadyBucket()
+            heapq.heappush(self._heap, rank)
+        bucket.add(await_)
+
+    def ready_removed(self, process):
+        self._buckets[self._ranks[process]].remove(process)
+
+    def _choose(self, ready_awaits):
+        if self._ranks is None:
+            self._ranks = self._rank_processes()
+            for await_ in ready_awaits:
+                self.ready_added(await_)
+            self._controller.network.set_ready_observer(self)
+        heap, buckets = self._heap, self._buckets
+        while not buckets[heap[0]].awaits:
+            del buckets[heapq.heappop(heap)]
+        return random.choice(buckets[heap[0]].awaits)
+
+
+class LeanNetwork(object):
+    # The network without its invariant checks, for programs already known to be wired and to behave; NaiveNetwork
+    # has the same semantics and asserts as it goes
     def __init__(self, controller):
         self._controller = controller
         controller.set_network(self)
@@ -54,41 +164,144 @@ class NaiveNetwork(object):
         self._await_outputs_by_source = {}
         self._active_processes = set()
         self._ready_awaits_by_process = {}
+        # Told of every await made ready or taken from the ready set, e.g. a dispatcher that indexes them
+        self._ready_observer = None
         self._process_inputs = defaultdict(set)
         self._process_outputs = defaultdict(set)
+        self._prevalidated = False
+        # Declared message forms: receiver -> {sender: form}, and the schemas they came from
+        self._channel_forms = defaultdict(dict)
+        self._channel_schemas = {}
+        # Blocked alternations with a timeout: dest process -> (timer, guard)
+        self._timeouts = {}
+        # Output guards of blocked alternations: dest process -> {offering process: [guards]}
+        self._output_guards_by_dest = defaultdict(dict)
+        # Starvation of the lower guards of priority alternations: process -> {action: [bypasses, streak, longest]},
+        # folded into totals by action name when the process is released
+        self._bypasses = {}
+        self._released_bypasses = {}
+        # Commands that found no partner waiting and had to block, a rough measure of contention
+        self._blocked_inputs = 0
+        self._blocked_outputs = 0
+        self._peak_blocked_outputs = 0
 
     @property
     def active_processes(self):
         return frozenset(self._active_processes)
 
+    @property
+    def num_active(self):
+        return len(self._active_processes)
+
+    def is_active(self, process):
+        return process in self._active_processes
+
+    @property
+    def blocked_inputs(self):
+        return self._blocked_inputs
+
+    @property
+    def blocked_outputs(self):
+        return self._blocked_outputs
+
+    @property
+    def peak_blocked_outputs(self):
+        # Most senders blocked at once, the values held up in the network
+        return self._peak_blocked_outputs
+
     @property
     def ready_awaits_by_process(self):
         return dict(self._ready_awaits_by_process)
 
+    @property
+    def num_ready(self):
+        return len(self._ready_awaits_by_process)
+
+    def ready_awaits(self):
+        # Without copying, so only to be iterated before the next change
+        return self._ready_awaits_by_process.itervalues()
+
+    def is_ready(self, process):
+        return process in self._ready_awaits_by_process
+
+    def snapshot(self):
+        # process -> (state, peers) for every active process, peers being those it is blocked on. An alternation
+        # counts as blocked on output only when all it offers is to send, and as waiting when it only has timeouts;
+        # its peers are everything it could take.
+        snapshot = {}
+        for process in self._active_processes:
+            if process in self._ready_awaits_by_process:
+                snapshot[process] = READY, ()
+            elif process in self._await_outputs_by_source:
+                snapshot[process] = BLOCKED_OUTPUT, (self._await_outputs_by_source[process].dest_process,)
+            elif process in self._await_inputs_by_dest:
+                state = WAITING
+                peers = set()
+                for guard in self._await_inputs_by_dest[process].guarded_matches:
+                    if isinstance(guard, OutputGuard):
+                        peers.add(guard.dest_process)
+                        if state is WAITING:
+                            state = BLOCKED_OUTPUT
+                    elif not isinstance(guard, TimeoutGuard):
+                        state = BLOCKED_INPUT
+                        if guard.source_process is None:
+                            peers.update(self._process_inputs[process])
+                        else:
+                            peers.add(guard.source_process)
+                snapshot[process] = state, tuple(peers)
+            else:
+                snapshot[process] = WAITING, ()
+        return snapshot
+
     def add_process(self, process):
+        if process in self._processes:
+            return
         self._processes.add(process)
         self._active_processes.add(process)
-        self._ready_awaits_by_process[process] = AwaitInit(process)
+        self.add_ready(AwaitInit(process))
+
+    def load_adjacency(self, processes, process_inputs, process_outputs):
+        # Bulk alternative to add_process_input/add_process_output, for adjacency that has already been validated
+        assert not self._processes
+        self._processes = set(processes)
+        self._active_processes = set(processes)
+        self._ready_awaits_by_process = {process: AwaitInit(process) for process in processes}
+        self._process_inputs = process_inputs
+        self._process_outputs = process_outputs
+        self._prevalidated = True
 
     def add_process_input(self, receiver, sender):
         self.add_process(receiver)
         self.add_process(sender)
         self._process_inputs[receiver].add(sender)
 
+    def outputs_of(self, process):
+        return self._process_outputs[process]
+
     def add_process_output(self, sender, receiver):
         self.add_process(sender)
         self.add_process(receiver)
         self._process_outputs[sender].add(receiver)
 
+    def declare_channel(self, sender, receiver, form, schema=None):
+        assert sender not in self._channel_forms[receiver], \
+            'Channel from {} to {} is already declared'.format(sender, receiver)
+        self._channel_forms[receiver][sender] = form
+        if schema is not None:
+            self._channel_schemas[(sender, receiver)] = schema
+
+    def channel_form(self, sender, receiver):
+        # On every message, and most networks declare no forms
+        if not self._channel_forms:
+            return None
+        forms = self._channel_forms.get(receiver)
+        return None if forms is None else forms.get(sender)
+
+    def channel_schema(self, sender, receiver):
+        return self._channel_schemas.get((sender, receiver))
+
     def validate(self):
-        for process, inputs in self._process_inputs.iteritems():
-            for input_ in inputs:
-                assert process in self._process_outputs[input_], \
-                    '{} expects input from {} but does not receive it'.format(process, input_)
-        for process, outputs in self._process_outputs.iteritems():
-            for output in outputs:
-                assert process in self._process_inputs[output], \
-                    '{} outputs to {} but is not expected'.format(process, output)
+        pass
 
     def await_(self, await_):
         if isinstance(await_, AwaitInput):
@@ -99,115 +312,425 @@ class NaiveNetwork(object):
             raise TypeError('Unknown await type {}'.format(type(await_)))
 
     def _await_input(self, await_input):
+        # An alternation: input guards, output guards and timeouts, of which the first that can go ahead is taken
         dest_process = await_input.dest_process
         guarded_matches = await_input.guarded_matches
-        assert not self._controller.is_ready(dest_process)
+
+        # Before anything is matched or recorded, so a missing Timers leaves the network as it was. Timeouts without
+        # a delay never fire, and those of no delay fire at once, so neither needs one.
+        if self._controller.timers is None and any(isinstance(guard, TimeoutGuard) and guard.delay is not None and
+                                                   guard.delay > 0 for guard in guarded_matches):
+            raise TypeError('Timeout guards need Timers')
 
         if not guarded_matches:
             dest_process.fail_await()
             self.add_ready(await_input)
             return
 
-        for input_guard, action in guarded_matches.items():
+        items = guarded_matches.items()
+        for position, (input_guard, action) in enumerate(items):
+            if isinstance(input_guard, TimeoutGuard):
+                continue
+            if isinstance(input_guard, OutputGuard):
+                accepting_guard = self._accepting_guard(dest_process, input_guard)
+                if accepting_guard is None:
+                    continue
+                if await_input.priority:
+                    self._record_bypasses(dest_process, action, items[position + 1:])
+                self._complete_alternation(input_guard.dest_process, accepting_guard, input_guard.value)
+                self._set_action(dest_process, input_guard, action, None)
+                self.add_ready(await_input)
+                return
             source_process = input_guard.source_process
             value = None
             if source_process is not None:
-                assert dest_process in self._process_outputs[source_process]
-                assert source_process in self._process_inputs[dest_process]
                 if source_process not in self._await_outputs_by_source:
-                    continue
+                    # The source may instead be offering the value from an alternation of its own
+                    output_guard = self._find_output_guard(source_process, dest_process, input_guard)
+                    if output_guard is None:
+                        continue
+                    if await_input.priority:
+                        self._record_bypasses(dest_process, action, items[position + 1:])
+                    self._set_action(dest_process, input_guard, action, output_guard.value)
+                    self.add_ready(await_input)
+                    self._complete_alternation(source_process, output_guard, None)
+                    return
                 await_output = self._await_outputs_by_source[source_process]
                 value = await_output.value
                 if await_output.dest_process is not dest_process:
                     continue
                 # TODO: better deadlock detection
-                if not input_guard.matches(source_process, value):
+                if not input_guard.matches(source_process, value, self.channel_form(source_process, dest_process)):
                     continue
 
-            if isinstance(action, str):
-                dest_process.set_branch_value(action, value)
-            else:
-                # should be callable
-                dest_process.set_callback_input(action, value)
+            if await_input.priority:
+                self._record_bypasses(dest_process, action, items[position + 1:])
+            self._set_action(dest_process, input_guard, action, value)
             await_output = self._await_outputs_by_source.pop(source_process)
             self.add_ready(await_input)
             self.add_ready(await_output)
             return
 
-        assert dest_process not in self._await_inputs_by_dest
         self._await_inputs_by_dest[dest_process] = await_input
+        self._blocked_inputs += 1
+        for guard in guarded_matches:
+            if isinstance(guard, OutputGuard):
+                self._output_guards_by_dest[guard.dest_process].setdefault(dest_process, []).append(guard)
+
+        timeouts = [input_guard for input_guard in guarded_matches
+                    if isinstance(input_guard, TimeoutGuard) and input_guard.delay is not None]
+        if timeouts:
+            timeout = min(timeouts, key=lambda input_guard: input_guard.delay)
+            if timeout.delay <= 0:
+                self._complete_alternation(dest_process, timeout, None)
+                return
+            timer = self._controller.timers.schedule(timeout.delay, lambda: self.expire_timeout(dest_process))
+            self._timeouts[dest_process] = (timer, timeout)
+
+    def _guard_ready(self, process, guard):
+        # Whether guard could be taken now, without taking it
+        if isinstance(guard, TimeoutGuard):
+            return False
+        if isinstance(guard, OutputGuard):
+            await_input = self._await_inputs_by_dest.get(guard.dest_process)
+            channel_form = self.channel_form(process, guard.dest_process)
+            return await_input is not None and any(input_guard.matches(process, guard.value, channel_form)
+                                                   for input_guard in await_input.guarded_matches)
+        source_process = guard.source_process
+        if source_process is None:
+            return True
+        await_output = self._await_outputs_by_source.get(source_process)
+        if await_output is not None:
+            return await_output.dest_process is process and guard.matches(
+                source_process, await_output.value, self.channel_form(source_process, process))
+        return self._find_output_guard(source_process, process, guard) is not None
+
+    def _record_bypasses(self, process, taken_action, later_items):
+        # Called once the taken guard is known and before anything changes: every ready guard after it is bypassed.
+        # A blocked alternation is completed by whichever partner arrives first, with nothing else ready, so bypasses
+        # can only happen when it is posted.
+        stats = self._bypasses.get(process)
+        if stats is not None and taken_action in stats:
+            stats[taken_action][1] = 0
+        for guard, action in later_items:
+            if not self._guard_ready(process, guard):
+                continue
+            if stats is None:
+                stats = self._bypasses[process] = {}
+            counts = stats.setdefault(action, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += 1
+            counts[2] = max(counts[2], counts[1])
+
+    @property
+    def priority_stats(self):
+        # (process, action) -> (times bypassed while ready, longest run of consecutive bypasses) for the guards of
+        # priority alternations that have lost out to a higher priority guard. Released processes are merged under
+        # (None, action name).
+        stats = dict(self._released_bypasses)
+        for process, counts_by_action in self._bypasses.iteritems():
+            for action, (bypasses, _, longest) in counts_by_action.iteritems():
+                stats[(process, action)] = bypasses, longest
+        return stats
+
+    @staticmethod
+    def _set_action(process, guard, action, value):
+        if isinstance(action, str):
+            process.set_branch_value(action, value, guard)
+        else:
+            # should be callable
+            process.set_callback_input(action, value, guard)
+
+    def _accepting_guard(self, source_process, output_guard):
+        # The guard that would take the output guard's value, if its destination is blocked in an alternation
+        dest_process = output_guard.dest_process
+        await_input = self._await_inputs_by_dest.get(dest_process)
+        if await_input is None:
+            return None
+        channel_form = self.channel_form(source_process, dest_process)
+        for input_guard in await_input.guarded_matches:
+            if input_guard.matches(source_process, output_guard.value, channel_form):
+                return input_guard
+        return None
+
+    def _find_output_guard(self, source_process, dest_process, input_guard):
+        channel_form = self.channel_form(source_process, dest_process)
+        for output_guard in self._output_guards_by_dest.get(dest_process, {}).get(source_process, ()):
+            if input_guard.matches(source_process, output_guard.value, channel_form):
+                return output_guard
+        return None
+
+    def _unregister_output_guard(self, process, output_guard):
+        offers = self._output_guards_by_dest[output_guard.dest_process]
+        offers[process].remove(output_guard)
+        if not offers[process]:
+            del offers[process]
+        if not offers:
+            del self._output_guards_by_dest[output_guard.dest_process]
+
+    def _complete_alternation(self, process, guard, value):
+        # Takes guard in the alternation process is blocked in
+        await_input = self._await_inputs_by_dest.pop(process)
+        for other in await_input.guarded_matches:
+            if isinstance(other, OutputGuard):
+                self._unregister_output_guard(process, other)
+        self._cancel_timeout(process)
+        action = await_input.guarded_matches[guard]
+        if await_input.priority and action in self._bypasses.get(process, ()):
+            self._bypasses[process][action][1] = 0
+        self._set_action(process, guard, action, value)
+        self.add_ready(await_input)
+
+    def _cancel_timeout(self, dest_process):
+        if dest_process in self._timeouts:
+            timer, _ = self._timeouts.pop(dest_process)
+            self._controller.timers.cancel(timer)
+
+    def expire_timeout(self, dest_process):
+        # Fires the timeout of a blocked alternation now; False if the process is not waiting on one
+        if dest_process not in self._timeouts:
+            return False
+        _, timeout = self._timeouts[dest_process]
+        self._complete_alternation(dest_process, timeout, None)
+        return True
+
+    def interrupt(self, dest_process, guard):
+        # Takes guard, typically a TimeoutGuard without a delay, in the alternation dest_process is blocked in, for
+        # events the network cannot see; False if it is not blocked on it
+        await_input = self._await_inputs_by_dest.get(dest_process)
+        if await_input is None or guard not in await_input.guarded_matches:
+            return False
+        self._complete_alternation(dest_process, guard, None)
+        return True
 
     def _await_output(self, await_output):
         source_process = await_output.source_process
         dest_process = await_output.dest_process
         value = await_output.value
-        assert not self._controller.is_ready(source_process)
-        assert source_process in self._process_inputs[dest_process]
-        assert dest_process in self._process_outputs[source_process]
 
         if not dest_process.active:
-            assert dest_process not in self._await_inputs_by_dest
             source_process.fail_await()
             self.add_ready(await_output)
             return
 
         if dest_process in self._await_inputs_by_dest:
-            for input_guard, action in self._await_inputs_by_dest[dest_process].guarded_matches.items():
-                if not input_guard.matches(source_process, value):
+            channel_form = self.channel_form(source_process, dest_process)
+            for input_guard in self._await_inputs_by_dest[dest_process].guarded_matches:
+                if not input_guard.matches(source_process, value, channel_form):
                     continue
-                if isinstance(action, str):
-                    dest_process.set_branch_value(action, value)
-                else:
-                    dest_process.set_callback_input(action, value)
-                await_input = self._await_inputs_by_dest.pop(dest_process)
                 self.add_ready(await_output)
-                self.add_ready(await_input)
+                self._complete_alternation(dest_process, input_guard, value)
                 return
 
-        assert source_process not in self._await_outputs_by_source
         self._await_outputs_by_source[source_process] = await_output
+        self._blocked_outputs += 1
+        self._peak_blocked_outputs = max(self._peak_blocked_outputs, len(self._await_outputs_by_source))
 
     def deactivate_process(self, process):
         self._active_processes.remove(process)
         for dest_process, await_input in self._await_inputs_by_dest.items():
             guarded_matches = await_input.guarded_matches
-            assert dest_process is not process
             for input_guard in guarded_matches.keys():
                 if not input_guard.viable:
+                    if isinstance(input_guard, OutputGuard):
+                        self._unregister_output_guard(dest_process, input_guard)
                     del guarded_matches[input_guard]
             if not guarded_matches:
                 await_input = self._await_inputs_by_dest.pop(dest_process)
+                self._cancel_timeout(dest_process)
                 dest_process.fail_await()
                 self.add_ready(await_input)
 
         for source_process, await_output in self._await_outputs_by_source.items():
-            assert source_process is not process
             if await_output.dest_process is process:
                 await_output = self._await_outputs_by_source.pop(source_process)
                 source_process.fail_await()
                 self.add_ready(await_output)
 
+        self._release_process(process)
+
+    def _release_process(self, process):
+        self._processes.discard(process)
+        for action, (bypasses, _, longest) in self._bypasses.pop(process, {}).iteritems():
+            # By name, so that callable actions do not keep their process alive
+            key = (None, action if isinstance(action, str) else getattr(action, '__name__', repr(action)))
+            released_bypasses, released_longest = self._released_bypasses.get(key, (0, 0))
+            self._released_bypasses[key] = released_bypasses + bypasses, max(released_longest, longest)
+        if self._channel_forms:
+            self._release_channels(process)
+        for receiver in self._process_outputs.pop(process, ()):
+            if receiver in self._process_inputs:
+                self._process_inputs[receiver].discard(process)
+        for sender in self._process_inputs.pop(process, ()):
+            if sender in self._process_outputs:
+                self._process_outputs[sender].discard(process)
+
+    def _release_channels(self, process):
+        # Declared channels must be wired, so the receivers of the process's own channels are among its outputs
+        for sender in self._channel_forms.pop(process, {}):
+            self._channel_schemas.pop((sender, process), None)
+        for receiver in self._process_outputs.get(process, ()):
+            forms = self._channel_forms.get(receiver)
+            if forms is not None and process in forms:
+                del forms[process]
+                if not forms:
+                    del self._channel_forms[receiver]
+                self._channel_schemas.pop((process, receiver), None)
+
+    def compact(self):
+        # Dicts and sets never shrink their tables on deletion, so rebuild them after many processes have gone
+        self._processes = set(self._processes)
+        self._await_inputs_by_dest = dict(self._await_inputs_by_dest)
+        self._await_outputs_by_source = dict(self._await_outputs_by_source)
+        self._active_processes = set(self._active_processes)
+        self._ready_awaits_by_process = dict(self._ready_awaits_by_process)
+        self._timeouts = dict(self._timeouts)
+        self._bypasses = dict(self._bypasses)
+        self._channel_forms = defaultdict(
+            dict, ((receiver, dict(forms)) for receiver, forms in self._channel_forms.iteritems()))
+        self._channel_schemas = dict(self._channel_schemas)
+        self._output_guards_by_dest = defaultdict(
+            dict, ((dest_process, dict(offers)) for dest_process, offers in self._output_guards_by_dest.iteritems()))
+        self._process_inputs = _compacted_adjacency(self._process_inputs)
+        self._process_outputs = _compacted_adjacency(self._process_outputs)
+
+    def set_ready_observer(self, observer):
+        # observer.ready_added(await_) and observer.ready_removed(process) are called after each change
+        self._ready_observer = observer
+
     def remove_ready(self, process):
-        assert process not in self._await_inputs_by_dest
-        assert process not in self._await_outputs_by_source
         del self._ready_awaits_by_process[process]
+        if self._ready_observer is not None:
+            self._ready_observer.ready_removed(process)
 
     def add_ready(self, await_):
         # Maybe should be private?
+        self._ready_awaits_by_process[await_.origin_process] = await_
+        if self._ready_observer is not None:
+            self._ready_observer.ready_added(await_)
+
+
+class NaiveNetwork(LeanNetwork):
+    # LeanNetwork checking its invariants: the wiring when it is validated, that processes only communicate over
+    # channels they registered, in any form declared for them, and only while not already waiting or ready
+    def _conforms(self, sender, receiver, value):
+        # Only called in asserts, so producers are checked against their channel's form when debugging
+        form = self.channel_form(sender, receiver)
+        return form is None or form_matches(form, value)
+
+    def validate(self):
+        # Declared channels are checked even when the adjacency was prevalidated
+        for receiver, forms in self._channel_forms.iteritems():
+            for sender in forms:
+                assert sender in self._process_inputs[receiver] and receiver in self._process_outputs[sender], \
+                    'Channel from {} to {} is declared but not wired'.format(sender, receiver)
+        if self._prevalidated:
+            return
+        for process, inputs in self._process_inputs.iteritems():
+            for input_ in inputs:
+                assert process in self._process_outputs[input_], \
+                    '{} expects input from {} but does not receive it'.format(process, input_)
+        for process, outputs in self._process_outputs.iteritems():
+            for output in outputs:
+                assert process in self._process_inputs[output], \
+                    '{} outputs to {} but is not expected'.format(process, output)
+
+    @staticmethod
+    def _check_unresolved(process):
+        # A process posting a command must have been resumed with everything the network left it
+        assert process.taken_action is None
+        assert not process.has_compute_result
+        assert not process.failed_await
+
+    def _await_input(self, await_input):
+        dest_process = await_input.dest_process
+        assert not self._controller.is_ready(dest_process)
+        assert dest_process not in self._await_inputs_by_dest
+        self._check_unresolved(dest_process)
+        for guard in await_input.guarded_matches:
+            if isinstance(guard, OutputGuard):
+                assert guard.dest_process in self._process_outputs[dest_process] or not guard.dest_process.active
+                assert dest_process in self._process_inputs[guard.dest_process] or not guard.dest_process.active
+                assert self._conforms(dest_process, guard.dest_process, guard.value), \
+                    '{} offers {!r} to {}, which is not of the declared form'.format(
+                        dest_process, guard.value, guard.dest_process)
+            elif guard.source_process is not None and guard.source_process.active:
+                assert dest_process in self._process_outputs[guard.source_process]
+                assert guard.source_process in self._process_inputs[dest_process]
+        super(NaiveNetwork, self)._await_input(await_input)
+
+    def _await_output(self, await_output):
+        source_process = await_output.source_process
+        dest_process = await_output.dest_process
+        assert not self._controller.is_ready(source_process)
+        self._check_unresolved(source_process)
+        if not dest_process.active:
+            # Adjacency of terminated processes has been released, so check this before the channel asserts
+            assert dest_process not in self._await_inputs_by_dest
+        else:
+            assert source_process in self._process_inputs[dest_process]
+            assert dest_process in self._process_outputs[source_process]
+            assert self._conforms(source_process, dest_process, await_output.value), \
+                '{} sends {!r} to {}, which is not of the declared form'.format(
+                    source_process, await_output.value, dest_process)
+            assert source_process not in self._await_outputs_by_source
+        super(NaiveNetwork, self)._await_output(await_output)
+
+    def deactivate_process(self, process):
+        assert process not in self._await_inputs_by_dest
+        assert process not in self._await_outputs_by_source
+        super(NaiveNetwork, self).deactivate_process(process)
+        assert process not in self._output_guards_by_dest
+
+    def _release_process(self, process):
+        assert process not in self._ready_awaits_by_process
+        super(NaiveNetwork, self)._release_process(process)
+
+    def remove_ready(self, process):
+        assert process not in self._await_inputs_by_dest
+        assert process not in self._await_outputs_by_source
+        super(NaiveNetwork, self).remove_ready(process)
+
+    @staticmethod
+    def _set_action(process, guard, action, value):
+        assert process.taken_action is None
+        LeanNetwork._set_action(process, guard, action, value)
+
+    def add_ready(self, await_):
         process = await_.origin_process
         assert process not in self._ready_awaits_by_process
         assert process not in self._await_inputs_by_dest
         assert process not in self._await_outputs_by_source
-        self._ready_awaits_by_process[process] = await_
+        # Whatever the process is resumed with must be in place, unless the command failed
+        if isinstance(await_, AwaitInput):
+            assert process.failed_await or process.taken_action is not None
+        elif isinstance(await_, AwaitCompute):
+            assert process.failed_await or process.has_compute_result
+        super(NaiveNetwork, self).add_ready(await_)
+
+
+def _compacted_adjacency(adjacency):
+    if isinstance(adjacency, CsrAdjacency):
+        return adjacency.compacted()
+    return defaultdict(set, ((process, set(neighbours)) for process, neighbours in adjacency.iteritems()))
 
 
 class Controller(object):
+    COMPACTION_MIN = 1024
+
     def __init__(self):
         self._dispatcher = None
         self._network = None
+        self._builder = None
+        self._offloader = None
+        self._poller = None
+        self._timers = None
 
         self._processes = set()
         self._runners_by_process = None
+        self._released_since_compaction = 0
+        self._serials = count()
+        self._steps = 0
 
         self._wired = False
 
@@ -219,6 +742,26 @@ class Controller(object):
     def ready_awaits_by_process(self):
         return self._network.ready_awaits_by_process if self._wired else {}
 
+    @property
+    def dispatcher(self):
+        return self._dispatcher
+
+    @property
+    def network(self):
+        return self._network
+
+    @property
+    def timers(self):
+        return self._timers
+
+    @property
+    def steps(self):
+        # Number of times a process has been resumed
+        return self._steps
+
+    def next_serial(self):
+        return next(self._serials)
+
     def set_dispatcher(self, dispatcher):
         assert self._dispatcher is None
         self._dispatcher = dispatcher
@@ -227,30 +770,77 @@ class Controller(object):
         assert self._network is None
         self._network = network
 
+    def set_offloader(self, offloader):
+        assert self._offloader is None
+        self._offloader = offloader
+        self._connect_wakeup()
+
+    def set_poller(self, poller):
+        assert self._poller is None
+        self._poller = poller
+        self._connect_wakeup()
+
+    def set_timers(self, timers):
+        assert self._timers is None
+        self._timers = timers
+
+    def _connect_wakeup(self):
+        # With both, the controller sleeps in the poller and finished computations wake it
+        if self._offloader is not None and self._poller is not None:
+            self._offloader.set_wakeup(self._poller.wake)
+
+    def set_builder(self, builder):
+        assert self._builder is None
+        assert not self._processes
+        self._builder = builder
+
     def add_process(self, process):
         assert not self._wired
+        if self._builder is not None:
+            self._builder.add_process(process)
+            return
         self._network.add_process(process)
         self._processes.add(process)
 
     def add_process_input(self, receiver, sender):
         assert not self._wired
+        if self._builder is not None:
+            self._builder.add_process_input(receiver, sender)
+            return
         self.add_process(receiver)
         self.add_process(sender)
         self._network.add_process_input(receiver, sender)
 
     def add_process_output(self, sender, receiver):
         assert not self._wired
+        if self._builder is not None:
+            self._builder.add_process_output(sender, receiver)
+            return
         self.add_process(sender)
         self.add_process(receiver)
         self._network.add_process_output(sender, receiver)
 
+    def declare_channel(self, sender, receiver, form):
+        # Declares what sender sends receiver: a form as for an InputGuard, or a Schema. Sends are checked against it
+        # when asserts are on, and guards on the channel whose form it implies skip checking each value.
+        assert not self._wired
+        if isinstance(form, Schema):
+            self._network.declare_channel(sender, receiver, form.form, form)
+        else:
+            self._network.declare_channel(sender, receiver, form)
+
     def wire(self):
+        if self._builder is not None:
+            self._builder.install(self._network)
+            self._processes = set(self._builder.processes)
+            # The network has the adjacency now; the builder would only keep finished processes alive
+            self._builder = None
         self._network.validate()
         self._runners_by_process = {process: process.run() for process in self._processes}
         self._wired = True
 
     def is_active(self, process):
-        return process in self.active_processes
+        return self._wired and self._network.is_active(process)
 
     def remove_ready(self, process):
         assert self._wired
@@ -261,7 +851,7 @@ class Controller(object):
         self._network.add_ready(await_)
 
     def is_ready(self, process):
-        return process in self.ready_awaits_by_process
+        return self._wired and self._network.is_ready(process)
 
     def process_runner(self, process):
         return self._runners_by_process[process]
@@ -269,18 +859,134 @@ class Controller(object):
     def deactivate_process(self, process):
         assert self._wired
         self._network.deactivate_process(process)
+        self._processes.discard(process)
+        del self._runners_by_process[process]
+
+        self._released_since_compaction += 1
+        if self._released_since_compaction >= max(self.COMPACTION_MIN, len(self._processes)):
+            self._compact()
 
-    def run(self):
+    def _compact(self):
+        self._processes = set(self._processes)
+        self._runners_by_process = dict(self._runners_by_process)
+        self._network.compact()
+        self._released_since_compaction = 0
+
+    def resume(self, await_):
+        # Run the process behind one ready await up to the next await it yields, without posting that await
         assert self._wired
-        while self.active_processes:
-            if not self.ready_awaits_by_process:
-                if self._dispatcher.processes_running:
-                    continue
-                raise DeadlockError('No processes can be run')
-            await_ = self._dispatcher.run_one(self.ready_awaits_by_process.itervalues())
-            if await_ is None:
-                continue
+        self._steps += 1
+        return self._dispatcher.resume(await_)
+
+    def post(self, await_):
+        assert self._wired
+        if isinstance(await_, AwaitIo):
+            if self._poller is None:
+                raise TypeError('Waiting on file descriptors needs an IoPoller')
+            self._poller.submit(await_)
+        elif not isinstance(await_, AwaitCompute):
             self._network.await_(await_)
+        elif self._offloader is not None:
+            self._offloader.submit(await_)
+        else:
+            # Without an offloader computations run in line, which keeps schedules reproducible
+            run_inline(await_)
+            self._network.add_ready(await_)
+
+    def run_await(self, await_):
+        next_await = self.resume(await_)
+        if next_await is not None:
+            self.post(next_await)
+        return next_await
+
+    def _poll_sources(self):
+        if self._offloader is not None and self._offloader.pending:
+            self._offloader.poll()
+        if self._poller is not None and self._poller.pending:
+            self._poller.poll()
+        if self._timers is not None and self._timers.pending and not self._timers.virtual:
+            self._timers.poll()
+
+    def _wait_sources(self, max_wait=None):
+        # Sleep until an offloaded computation, a file descriptor or a deadline makes a process ready, or for at
+        # most max_wait seconds; False if nothing could
+        offloader, poller, timers = self._offloader, self._poller, self._timers
+        offloader_pending = offloader is not None and offloader.pending
+        timers_pending = timers is not None and timers.pending
+        if timers_pending and timers.virtual:
+            # Virtual time passes only when the network is idle, and then all at once
+            timers.wait()
+            return True
+        timeout = timers.time_to_next() if timers_pending else None
+        cut_short = max_wait is not None and (timeout is None or max_wait < timeout)
+        if cut_short:
+            timeout = max_wait
+        if poller is not None and (poller.pending or offloader_pending):
+            poller.wait(timeout)
+            if offloader_pending:
+                offloader.poll()
+        elif offloader_pending:
+            offloader.wait(timeout)
+        elif timers_pending:
+            if cut_short:
+                time.sleep(timeout)
+                return True
+            timers.wait()
+            return True
+        else:
+            return False
+        if timers_pending:
+            timers.poll()
+        return True
+
+    def step(self):
+        # Resumes one ready process, without waiting for one to become ready; False if none was
+        assert self._wired
+        self._poll_sources()
+        network = self._network
+        if not network.num_ready:
+            return False
+        self._steps += 1
+        await_ = self._dispatcher.run_one(network.ready_awaits())
+        if await_ is not None:
+            self.post(await_)
+        return True
+
+    @property
+    def finished(self):
+        return self._wired and not self._network.num_active
+
+    def run(self, max_steps=None, deadline=None):
+        # Runs until every process has finished, returning True, or until max_steps processes have been resumed or
+        # time.time() has reached deadline, returning False. Another call carries on from where this one stopped.
+        return self._run_slice(max_steps, deadline, None)
+
+    def run_until(self, predicate, max_steps=None, deadline=None):
+        # Like run, but also stops as soon as predicate() holds after a step, and returns whether it does. Only the
+        # predicate is called between steps, so it should check what the processes have recorded rather than search
+        # the network.
+        return self._run_slice(max_steps, deadline, predicate)
+
+    def _run_slice(self, max_steps, deadline, predicate):
+        assert self._wired
+        network = self._network
+        steps = 0
+        while network.num_active:
+            if max_steps is not None and steps >= max_steps:
+                return False
+            if deadline is not None and time.time() >= deadline:
+                return False
+            if self.step():
+                steps += 1
+                if predicate is not None and predicate():
+                    return True
+                continue
+            if self._wait_sources(None if deadline is None else max(deadline - time.time(), 0.0)):
+                continue
+            if self._dispatcher.processes_running:
+                continue
+            raise DeadlockError('No processes can be run')
+        return predicate is None or bool(predicate())
 
 
 
@@ -0,0 +1,168 @@
+import os
+import random
+import sys
+from timeit import default_timer
+
+from papers.csp import dining_philosophers, eratosthenes
+from papers.csp.composite import build_composite_ex_4_6
+from papers.csp.controller import Controller, LeanNetwork, NaiveNetwork, SequentialDispatcher, DeadlockError
+from papers.csp.exercises import build_ex_4_5, build_ex_4_6, Ex44Runner, Ex46Runner, DivMod, \
+    PipelinedDivModRunner
+from papers.csp.farm import Farm
+from papers.csp.monte_carlo import COMPLETED, DEADLOCK, ERROR
+from papers.csp.process import Process, AwaitInput, AwaitOutput
+from papers.csp.set_tree import build_set_tree
+from papers.csp.sharded_set import build_sharded_set
+
+
+# Runs examples on LeanNetwork and NaiveNetwork from the same seed and compares what their processes did. Both
+# networks should make the same choices, so the traces should be identical; NaiveNetwork also checks its invariants
+# on the way, so a failed assert shows up as an error on that side only.
+
+
+def _describe(value):
+    # Something comparable between runs: processes by serial, which is their hash, and no object addresses
+    if isinstance(value, Process):
+        return 'process', hash(value)
+    if isinstance(value, tuple):
+        return type(value).__name__, tuple(_describe(item) for item in value)
+    if isinstance(value, list):
+        return 'list', tuple(_describe(item) for item in value)
+    if type(value).__repr__ is object.__repr__:
+        return type(value).__name__
+    return repr(value)
+
+
+def _event(await_):
+    process = hash(await_.origin_process)
+    if isinstance(await_, AwaitOutput):
+        return 'output', process, hash(await_.dest_process), _describe(await_.value)
+    if isinstance(await_, AwaitInput):
+        partners = sorted(_describe(getattr(guard, 'source_process', getattr(guard, 'dest_process', None)))
+                          for guard in await_.guarded_matches)
+        return 'input', process, tuple(partners)
+    return type(await_).__name__, process
+
+
+class _TracingDispatcher(SequentialDispatcher):
+    def __init__(self, controller, trace):
+        super(_TracingDispatcher, self).__init__(controller)
+        self._trace = trace
+
+    def run_one(self, ready_awaits):
+        await_ = super(_TracingDispatcher, self).run_one(ready_awaits)
+        self._trace.append(None if await_ is None else _event(await_))
+        return await_
+
+
+def run_traced(network_class, build, seed, params=()):
+    # Like monte_carlo.run_once, but for any network, and returning (outcome, trace, elapsed). Output printed by the
+    # example is discarded.
+    random.seed(seed)
+    controller = Controller()
+    network_class(controller)
+    trace = []
+    _TracingDispatcher(controller, trace)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = default_timer()
+    try:
+        build(controller, **dict(params))
+        controller.wire()
+        controller.run()
+        outcome = COMPLETED
+    except DeadlockError:
+        outcome = DEADLOCK
+    except Exception as e:
+        outcome = ERROR, repr(e)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return outcome, trace, default_timer() - start
+
+
+def first_difference(lean_trace, naive_trace):
+    for index, (lean_event, naive_event) in enumerate(zip(lean_trace, naive_trace)):
+        if lean_event != naive_event:
+            return index
+    if len(lean_trace) != len(naive_trace):
+        return min(len(lean_trace), len(naive_trace))
+    return None
+
+
+def _ex_4_5(controller, size=32):
+    build_ex_4_5(controller, random.sample(range(1000), size))
+
+
+def _ex_4_6(controller, size=32):
+    build_ex_4_6(controller, random.sample(range(1000), size))
+
+
+def _composite_ex_4_6(controller, size=32):
+    build_composite_ex_4_6(controller, random.sample(range(1000), size))
+
+
+def _set_tree(controller, size=32):
+    build_set_tree(controller, Ex46Runner(controller, random.sample(range(1000), size)), 0, 1000)
+
+
+def _sharded_set(controller, size=150, num_shards=4):
+    runner = Ex44Runner(controller, set(random.sample(range(4 * size), size)))
+    runner.set_worker('set', build_sharded_set(controller, runner, num_shards))
+
+
+def _farm(controller, num_workers=3):
+    runner = PipelinedDivModRunner(controller, [(1000 * (i % 3 + 1), 7 + i) for i in range(12)])
+    farm = Farm(controller)
+    farm.add_caller(runner)
+    runner.set_worker('farm', farm)
+    for _ in range(num_workers):
+        worker = DivMod(controller)
+        worker.set_caller(farm)
+        farm.add_worker(worker)
+
+
+EXAMPLES = [
+    ('dining_philosophers', dining_philosophers.build, {'seats': 5, 'lifespan': 50}),
+    ('eratosthenes', eratosthenes.build, {'sieves': 25, 'limit': 100}),
+    ('ex_4_5', _ex_4_5, {}),
+    ('ex_4_6', _ex_4_6, {}),
+    ('composite_ex_4_6', _composite_ex_4_6, {}),
+    ('set_tree', _set_tree, {}),
+    ('sharded_set', _sharded_set, {}),
+    ('farm', _farm, {}),
+]
+
+
+def compare(build, seed, params=()):
+    # (index of the first differing event or None, lean result, naive result)
+    lean = run_traced(LeanNetwork, build, seed, params)
+    naive = run_traced(NaiveNetwork, build, seed, params)
+    index = first_difference(lean[1], naive[1])
+    if index is None and lean[0] != naive[0]:
+        index = len(lean[1])
+    return index, lean, naive
+
+
+def run(seeds=range(10), examples=EXAMPLES):
+    differences = 0
+    for name, build, params in examples:
+        events = 0
+        outcomes = {}
+        lean_time = naive_time = 0.0
+        for seed in seeds:
+            index, lean, naive = compare(build, seed, params)
+            events += len(lean[1])
+            outcome = lean[0] if lean[0] in (COMPLETED, DEADLOCK) else ERROR
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            lean_time += lean[2]
+            naive_time += naive[2]
+            if index is not None:
+                differences += 1
+                print('{} seed {}: traces differ at event {}: lean {} {}, naive {} {}'.format(
+                    name, seed, index, lean[0], lean[1][index:index + 1], naive[0], naive[1][index:index + 1]))
+        print('{}: {} seeds {}, {} events, lean {:.3f}s, naive {:.3f}s'.format(
+            name, len(seeds), outcomes, events, lean_time, naive_time))
+    print('{} differences'.format(differences))
+    return differences
@@ -1,6 +1,7 @@
 from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
 from papers.csp.io_semantics import Signal, InputGuard, CommandFailure
 from papers.csp.process import Process
+from papers.csp.process_array import ProcessArray
 
 
 class Enter(Signal):
@@ -131,24 +132,29 @@ class Room(Process):
                 break
 
 
-def run(seats=5, lifespan=1000):
-    controller = Controller()
-    NaiveNetwork(controller)
-    SequentialDispatcher(controller)
-
-    philosophers = [Philosopher(controller, lifespan) for _ in range(seats)]
-    forks = [Fork(controller) for _ in range(seats)]
+def build(controller, seats=5, lifespan=1000):
+    philosophers = ProcessArray(controller, Philosopher, seats, lifespan)
+    forks = ProcessArray(controller, Fork, seats)
     for i in range(seats):
         philosophers[i].set_left_fork(forks[i])
         forks[i].set_right_philosopher(philosophers[i])
 
-        philosophers[i].set_right_fork(forks[i-1])
-        forks[i-1].set_left_philosopher(philosophers[i])
+        right_fork = forks.neighbour(i, -1, wrap=True)
+        philosophers[i].set_right_fork(right_fork)
+        right_fork.set_left_philosopher(philosophers[i])
 
     room = Room(controller)
     room.add_philosophers(*philosophers)
     [philosopher.set_room(room) for philosopher in philosophers]
 
+
+def run(seats=5, lifespan=1000):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    build(controller, seats, lifespan)
+
     controller.wire()
     controller.run()
 
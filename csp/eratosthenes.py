@@ -1,6 +1,12 @@
-from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+import os
+import random
+import sys
+from timeit import default_timer
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher, DataflowDispatcher
 from papers.csp.io_semantics import InputGuard, CommandFailure
 from papers.csp.process import Process
+from papers.csp.process_array import ProcessArray
 
 
 class Sieve(Process):
@@ -82,6 +88,7 @@ class Print(Process):
     def __init__(self, controller):
         super(Print, self).__init__(controller)
         self._inputs = set()
+        self.printed = 0
 
     def add_inputs(self, *inputs):
         self._inputs |= set(inputs)
@@ -96,30 +103,85 @@ class Print(Process):
             try:
                 _, to_print = yield self.await_input(matches)
                 print to_print
+                self.printed += 1
             except CommandFailure:
                 break
 
 
-def run(sieves=1229, limit=10000):
-    controller = Controller()
-    NaiveNetwork(controller)
-    SequentialDispatcher(controller)
-
+def build(controller, sieves=1229, limit=10000):
     print_ = Print(controller)
 
     seed = Seed(controller, limit)
     seed.set_print(print_)
     print_.add_inputs(seed)
 
-    previous = seed
-    for _ in xrange(sieves):
-        sieve = Sieve(controller)
+    sieve_array = ProcessArray(controller, Sieve, sieves)
+    for sieve in sieve_array:
         sieve.set_print(print_)
-        print_.add_inputs(sieve)
+    print_.add_inputs(*sieve_array)
+
+    seed.set_next(sieve_array[0])
+    sieve_array[0].set_previous(seed)
+
+    def connect(sieve, next_):
+        sieve.set_next(next_)
+        next_.set_previous(sieve)
+    sieve_array.chain(connect)
+    return print_
+
+
+def run(sieves=1229, limit=10000):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
 
-        previous.set_next(sieve)
-        sieve.set_previous(previous)
-        previous = sieve
+    build(controller, sieves, limit)
 
     controller.wire()
     controller.run()
+
+
+def run_in_slices(sieves=1229, limit=10000, steps_per_slice=1000, first=10):
+    # As a service loop embedding the network would: the first few primes as soon as they are out, then the rest
+    # in slices with other work free to go between them
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    print_ = build(controller, sieves, limit)
+
+    controller.wire()
+    controller.run_until(lambda: print_.printed >= first)
+    print('First {} primes after {} steps'.format(print_.printed, controller.steps))
+    slices = 0
+    while not controller.run(max_steps=steps_per_slice):
+        slices += 1
+    print('Remaining {} primes in {} slices of {} steps'.format(print_.printed - first, slices + 1, steps_per_slice))
+
+
+def _measure(dispatcher_class, sieves, limit, seed):
+    random.seed(seed)
+    controller = Controller()
+    network = NaiveNetwork(controller)
+    dispatcher_class(controller)
+    build(controller, sieves, limit)
+    controller.wire()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = default_timer()
+    try:
+        controller.run()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return controller.steps, network.blocked_outputs, network.peak_blocked_outputs, default_timer() - start
+
+
+def benchmark(sieves=1229, limit=10000, seeds=(0, 1, 2)):
+    # The random schedule against draining the chain from its far end
+    for dispatcher_class in (SequentialDispatcher, DataflowDispatcher):
+        for seed in seeds:
+            steps, blocked, peak, elapsed = _measure(dispatcher_class, sieves, limit, seed)
+            print('{} seed {}: {} steps, {} blocked sends, at most {} at once, {:.3f}s'.format(
+                dispatcher_class.__name__, seed, steps, blocked, peak, elapsed))
@@ -1,10 +1,16 @@
+import mmap
+import os
 import random
-from collections import namedtuple
+import sys
+import tempfile
+from collections import namedtuple, deque
 
 from papers.csp.controller import Controller, SequentialDispatcher, NaiveNetwork, DeadlockError
-from papers.csp.io_semantics import InputGuard, CommandFailure, NTuple, Signal
+from papers.csp.io_semantics import InputGuard, OutputGuard, CommandFailure, NTuple, Signal
+from papers.csp.offload import Offloader
 from papers.csp.process import SingleInputProcess, SingleOutputProcess, SingleInputOutputProcess, \
     SimpleAsyncWorkerProcess, AsyncCallerProcess, Process
+from papers.csp.schema import Schema
 
 
 class SendChars(SingleOutputProcess):
@@ -94,12 +100,43 @@ class ImprovedSquash(SingleInputOutputProcess):
 class CardFile(SingleOutputProcess):
     def __init__(self, controller, data):
         super(CardFile, self).__init__(controller)
-        self._remaining_data = data[:]
+        self._data = data
+
+    def _run(self):
+        for start in xrange(0, len(self._data), 80):
+            yield self.await_output(self._output_process, self._data[start:start + 80])
+
+
+class StreamingCardFile(SingleOutputProcess):
+    # Reads each card from fileobj only when it is about to be sent, so the deck need not fit in memory; with
+    # use_mmap the file is mapped and sliced instead of read. Cards go out as str: an output's value is copied on
+    # the way, which a memoryview into the map does not survive.
+    def __init__(self, controller, fileobj, use_mmap=False):
+        super(StreamingCardFile, self).__init__(controller)
+        self._fileobj = fileobj
+        self._use_mmap = use_mmap
+
+    def _cards(self):
+        fileno = self._fileobj.fileno()
+        # An empty file cannot be mapped
+        if self._use_mmap and os.fstat(fileno).st_size:
+            buffer_ = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, len(buffer_), 80):
+                    yield buffer_[start:start + 80]
+            finally:
+                buffer_.close()
+            return
+
+        while True:
+            card = self._fileobj.read(80)
+            if not card:
+                break
+            yield card
 
     def _run(self):
-        while self._remaining_data:
-            output, self._remaining_data = self._remaining_data[:80], self._remaining_data[80:]
-            yield self.await_output(self._output_process, output)
+        for card in self._cards():
+            yield self.await_output(self._output_process, card)
 
 
 class Disassemble(SingleInputOutputProcess):
@@ -117,19 +154,50 @@ class Disassemble(SingleInputOutputProcess):
 
 
 class Assemble(SingleInputOutputProcess):
+    # Fills one 125 byte line image in place; an output's value is copied on the way, so the same buffer is reused
+    # for every line
     def _run(self):
-        lineimage = []
+        lineimage = bytearray(125)
+        i = 0
         while True:
             try:
                 _, char = yield self.await_input(InputGuard.single_match(self._input_process))
-                lineimage.append(char)
-                if len(lineimage) >= 125:
+                lineimage[i] = char
+                i += 1
+                if i >= 125:
                     yield self.await_output(self.output_process, lineimage)
-                    lineimage = []
+                    i = 0
             except CommandFailure:
-                if lineimage:
-                    lineimage += [' '] * (125 - len(lineimage))
-                yield self.await_output(self.output_process, lineimage)
+                if i:
+                    lineimage[i:] = ' ' * (125 - i)
+                    yield self.await_output(self.output_process, lineimage)
+                break
+
+
+class CardsToLines(SingleInputOutputProcess):
+    # Disassemble and Assemble in one, copying whole cards into the line image rather than passing on each
+    # character
+    def _run(self):
+        lineimage = bytearray(125)
+        i = 0
+        while True:
+            try:
+                _, card = yield self.await_input(InputGuard.single_match(self._input_process))
+                assert len(card) <= 80
+                card += ' '
+                start = 0
+                while start < len(card):
+                    count = min(len(card) - start, 125 - i)
+                    lineimage[i:i + count] = card[start:start + count]
+                    start += count
+                    i += count
+                    if i >= 125:
+                        yield self.await_output(self.output_process, lineimage)
+                        i = 0
+            except CommandFailure:
+                if i:
+                    lineimage[i:] = ' ' * (125 - i)
+                    yield self.await_output(self.output_process, lineimage)
                 break
 
 
@@ -139,23 +207,40 @@ class LinePrinter(SingleInputProcess):
             try:
                 _, line = yield self.await_input(InputGuard.single_match(self._input_process))
                 assert len(line) == 125
-                print ''.join(line)
+                sys.stdout.write(line)
+                sys.stdout.write('\n')
             except CommandFailure:
                 break
 
 
+def divmod_by_subtraction(dividend, divisor):
+    assert dividend >= 0 and divisor > 0
+    quotient = 0
+    remainder = dividend
+    while remainder >= divisor:
+        remainder -= divisor
+        quotient += 1
+    return quotient, remainder
+
+
 class DivMod(SimpleAsyncWorkerProcess):
     def _run(self):
         while True:
             try:
                 _, (dividend, divisor) = yield self.await_input(InputGuard.single_match(self.caller_process, NTuple(2)))
-                assert dividend >= 0 and divisor > 0
-                quotient = 0
-                remainder = dividend
-                while remainder >= divisor:
-                    remainder -= divisor
-                    quotient += 1
-                yield self.await_output(self.caller_process, (quotient, remainder))
+                yield self.await_output(self.caller_process, divmod_by_subtraction(dividend, divisor))
+            except CommandFailure:
+                break
+
+
+class OffloadedDivMod(SimpleAsyncWorkerProcess):
+    # The subtraction loop runs in the offloader's pool, so other processes are scheduled while it does
+    def _run(self):
+        while True:
+            try:
+                _, (dividend, divisor) = yield self.await_input(InputGuard.single_match(self.caller_process, NTuple(2)))
+                result = yield self.await_compute(divmod_by_subtraction, dividend, divisor)
+                yield self.await_output(self.caller_process, result)
             except CommandFailure:
                 break
 
@@ -172,6 +257,24 @@ class DivModRunner(AsyncCallerProcess):
             print "{}/{} = {} + {}/{}".format(dividend, divisor, quotient, remainder, divisor)
 
 
+class PipelinedDivModRunner(AsyncCallerProcess):
+    # Keeps every worker busy: requests are dealt out round robin and replies collected as they arrive
+    def __init__(self, controller, problems):
+        super(PipelinedDivModRunner, self).__init__(controller)
+        self._problems = problems
+
+    def _run(self):
+        keys = sorted(self._workers)
+        futures = [self.submit(keys[i % len(keys)], problem) for i, problem in enumerate(self._problems)]
+        while self.pending_calls:
+            yield self.await_progress()
+            for future in self.completed():
+                dividend, divisor = future.request
+                quotient, remainder = future.result
+                print "#{} {}/{} = {} + {}/{}".format(future.call_id, dividend, divisor, quotient, remainder, divisor)
+        assert all(future.done for future in futures)
+
+
 def trivial():
     controller = Controller()
     # Maybe not best interface?
@@ -267,6 +370,27 @@ def ex3_5():
     controller.run()
 
 
+def ex3_5_lines():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    data_seed = '0123456789*0246813579'
+    data = ''.join(c * 10 for c in data_seed)
+    west = CardFile(controller, data)
+    east = LinePrinter(controller)
+
+    cards_to_lines = CardsToLines(controller)
+    west.set_output(cards_to_lines)
+    cards_to_lines.set_input(west)
+
+    cards_to_lines.set_output(east)
+    east.set_input(cards_to_lines)
+
+    controller.wire()
+    controller.run()
+
+
 def ex3_6():
     controller = Controller()
     SequentialDispatcher(controller)
@@ -296,6 +420,39 @@ def ex3_6():
     controller.run()
 
 
+def ex3_6_streaming(use_mmap=True):
+    data_seed = '0123456789*0246813579'
+    with tempfile.TemporaryFile() as fileobj:
+        fileobj.write(''.join(c * 10 for c in data_seed))
+        fileobj.flush()
+        fileobj.seek(0)
+
+        controller = Controller()
+        SequentialDispatcher(controller)
+        NaiveNetwork(controller)
+
+        west = StreamingCardFile(controller, fileobj, use_mmap)
+        east = LinePrinter(controller)
+
+        disassemble = Disassemble(controller)
+        west.set_output(disassemble)
+        disassemble.set_input(west)
+
+        squash = Squash(controller)
+        disassemble.set_output(squash)
+        squash.set_input(disassemble)
+
+        assemble = Assemble(controller)
+        squash.set_output(assemble)
+        assemble.set_input(squash)
+
+        assemble.set_output(east)
+        east.set_input(assemble)
+
+        controller.wire()
+        controller.run()
+
+
 def ex_4_1():
     controller = Controller()
     SequentialDispatcher(controller)
@@ -310,6 +467,63 @@ def ex_4_1():
     controller.run()
 
 
+def ex_4_1_pipelined(num_workers=3):
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    divmod_runner = PipelinedDivModRunner(controller, [(22, 7), (81, 9), (10, 1), (100, 7), (5, 3), (64, 8)])
+    for i in range(num_workers):
+        divmod_ = DivMod(controller)
+        divmod_.set_caller(divmod_runner)
+        divmod_runner.set_worker('divmod{}'.format(i), divmod_)
+
+    controller.wire()
+    controller.run()
+
+
+def ex_4_1_typed():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    divmod_ = DivMod(controller)
+    divmod_runner = DivModRunner(controller, [(22, 7), (81, 9), (10, 1)])
+    divmod_.set_caller(divmod_runner)
+    divmod_runner.set_worker('divmod', divmod_)
+
+    # Both directions carry pairs of integers, so the NTuple(2) guards at either end need not check them
+    pairs = Schema(NTuple(2), 'qq')
+    divmod_.declare_input(divmod_runner, pairs)
+    divmod_runner.declare_input(divmod_, pairs)
+
+    controller.wire()
+    controller.run()
+
+    record = pairs.pack((22, 7))
+    print '(22, 7) packs to {} bytes: {!r}, unpacking to {}'.format(len(record), record, pairs.unpack(record))
+
+
+def ex_4_1_offloaded(workers=None):
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+    offloader = Offloader(controller, workers)
+
+    problems = [[(22, 7), (81, 9), (10, 1)], [(10 ** 7, 3), (5, 5)], [(10 ** 6, 7), (0, 4), (100, 11)]]
+    for runner_problems in problems:
+        divmod_ = OffloadedDivMod(controller)
+        divmod_runner = DivModRunner(controller, runner_problems)
+        divmod_.set_caller(divmod_runner)
+        divmod_runner.set_worker('divmod', divmod_)
+
+    controller.wire()
+    try:
+        controller.run()
+    finally:
+        offloader.close()
+
+
 class Factorial(Process):
     def __init__(self, controller):
         super(Factorial, self).__init__(controller)
@@ -784,16 +998,10 @@ class Set45Worker(Process):
                 break
 
 
-def ex_4_5():
-    controller = Controller()
-    NaiveNetwork(controller)
-    SequentialDispatcher(controller)
-
-    inputs = random.sample(range(1000), 32)
-
+def build_ex_4_5(controller, inputs, size=100):
     runner = Ex45Runner(controller, inputs)
     previous = runner
-    for i in range(100):
+    for i in range(size):
         worker = Set45Worker(controller)
         worker.set_previous_process(previous)
         if i == 0:
@@ -809,6 +1017,15 @@ def ex_4_5():
     previous.set_next_process(fail)
     fail.add_input_process(previous)
 
+
+def ex_4_5():
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    inputs = random.sample(range(1000), 32)
+    build_ex_4_5(controller, inputs)
+
     controller.wire()
     controller.run()
 
@@ -954,16 +1171,10 @@ class Ex46Runner(Process):
         assert not inserted
 
 
-def ex_4_6():
-    controller = Controller()
-    NaiveNetwork(controller)
-    SequentialDispatcher(controller)
-
-    inputs = random.sample(range(1000), 32)
-
+def build_ex_4_6(controller, inputs, size=100):
     runner = Ex46Runner(controller, inputs)
     previous = runner
-    for i in range(100):
+    for i in range(size):
         worker = Set46Worker(controller)
         worker.set_previous_process(previous)
         if i == 0:
@@ -981,7 +1192,126 @@ def ex_4_6():
     # will not output, ok since it fails on any input and it would receive input first
     fail.register_outputs(previous)
 
+
+def ex_4_6():
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    inputs = random.sample(range(1000), 32)
+    build_ex_4_6(controller, inputs)
+
     controller.wire()
     controller.run()
 
     print 'Ran to completion'
+
+
+class BoundedBuffer(SingleInputOutputProcess):
+    # Hoare's 5.1 with an output guard in place of the consumer's more() request
+    def __init__(self, controller, capacity=10):
+        super(BoundedBuffer, self).__init__(controller)
+        self._capacity = capacity
+
+    def _run(self):
+        buffer = deque()
+        while True:
+            try:
+                branch, value = yield self.await_input({
+                    InputGuard(self._input_process, boolean_result=len(buffer) < self._capacity): 'put',
+                    OutputGuard(self._output_process, buffer[0] if buffer else None, boolean_result=bool(buffer)): 'get'})
+            except CommandFailure:
+                break
+            if branch == 'put':
+                buffer.append(value)
+                continue
+            assert branch == 'get'
+            buffer.popleft()
+
+
+def ex_5_1():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    producer = SendChars(controller, 'Hello world!')
+    buffer_ = BoundedBuffer(controller, 4)
+    consumer = ReceiveChars(controller)
+    producer.set_output(buffer_)
+    buffer_.set_input(producer)
+    buffer_.set_output(consumer)
+    consumer.set_input(buffer_)
+
+    controller.wire()
+    controller.run()
+
+
+class Stop(Signal):
+    pass
+
+
+class SendStop(SingleOutputProcess):
+    def _run(self):
+        yield self.await_output(self._output_process, Stop())
+
+
+class SendCharsUntilRefused(SendChars):
+    def _run(self):
+        for datum in self._data:
+            try:
+                yield self.await_output(self._output_process, datum)
+            except CommandFailure:
+                break
+
+
+class ControlledCopy(SingleInputOutputProcess):
+    # Copy with a control channel that takes priority over the data, so a stop is never stuck behind input
+    def __init__(self, controller):
+        super(ControlledCopy, self).__init__(controller)
+        self._control_process = None
+
+    def set_control(self, process):
+        self._control_process = process
+        self.register_inputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return super(ControlledCopy, self)._is_run_ready and self._control_process is not None
+
+    def _run(self):
+        copied = 0
+        while True:
+            try:
+                branch, value = yield self.await_priority_input([(InputGuard(self._control_process, Stop), 'stop'),
+                                                                 (InputGuard(self._input_process), 'data')])
+            except CommandFailure:
+                break
+            if branch == 'stop':
+                print('Stopped after copying {}'.format(copied))
+                break
+            assert branch == 'data'
+            yield self.await_output(self._output_process, value)
+            copied += 1
+
+
+def ex_priority():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    network = NaiveNetwork(controller)
+
+    west = SendCharsUntilRefused(controller, 'Hello world!' * 10)
+    stopper = SendStop(controller)
+    copy = ControlledCopy(controller)
+    east = ReceiveChars(controller)
+    west.set_output(copy)
+    stopper.set_output(copy)
+    copy.set_input(west)
+    copy.set_control(stopper)
+    copy.set_output(east)
+    east.set_input(copy)
+
+    controller.wire()
+    controller.run()
+
+    for (_, branch), (bypasses, longest) in network.priority_stats.iteritems():
+        print('{} bypassed {} times, at most {} in a row'.format(branch, bypasses, longest))
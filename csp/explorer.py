@@ -0,0 +1,546 @@
+import hashlib
+import random
+import types
+from collections import namedtuple, deque
+from multiprocessing import Manager, Pool
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.io_semantics import InputGuard, OutputGuard, TimeoutGuard
+from papers.csp.network_builder import NetworkBuilder
+from papers.csp.process import Process, AwaitInput, AwaitOutput
+from papers.csp.timers import Timers, VirtualClock
+
+
+# Schedules are tuples of events, each a tuple of the process ids (dense ids from the NetworkBuilder) taking part
+ExplorationResult = namedtuple('ExplorationResult',
+                               ['states', 'transitions', 'completions', 'deadlocks', 'errors', 'truncated'])
+
+
+class _Execution(object):
+    # One live run of the network. Every live process is held at its next await without posting it, so a state
+    # is a set of pending commands and a step is one event between them: a rendezvous of an output with an input
+    # that accepts it, or a command that fails or needs no partner. The explorer picks the event and its awaits
+    # are posted as a pair, so the network can only match those two. Generators cannot be copied, so returning
+    # to an earlier state means building the network again and replaying the events that led there.
+    def __init__(self, build, seed):
+        random.seed(seed)
+        self.controller = Controller()
+        NaiveNetwork(self.controller)
+        # Only ever asked to resume a given await, which makes no choice, so replays leave the seeded random stream
+        # alone; processes may draw on it and its state is part of the network's
+        SequentialDispatcher(self.controller)
+        # Timeouts fire when the explorer chooses, as if any amount of time could pass between events
+        Timers(self.controller, VirtualClock())
+        self.builder = NetworkBuilder(self.controller)
+        build(self.controller)
+        self.controller.wire()
+        self.schedule = ()
+        self._pending = {}
+        self._settle(set())
+
+    def _settle(self, touched):
+        # Resume every ready process up to its next await, which only touches the process itself
+        builder = self.builder
+        ready = self.controller.ready_awaits_by_process
+        while ready:
+            process = min(ready, key=builder.process_id)
+            process_id = builder.process_id(process)
+            touched.add(process_id)
+            next_await = self.controller.resume(ready[process])
+            if next_await is None:
+                # Termination fails the commands of every neighbour
+                touched.update(builder.neighbour_ids(process_id))
+            else:
+                self._pending[process_id] = next_await
+            ready = self.controller.ready_awaits_by_process
+
+    @staticmethod
+    def _prune(await_):
+        # The network prunes guards on terminated processes from posted awaits; pending ones are done here
+        if isinstance(await_, AwaitInput):
+            guarded_matches = await_.guarded_matches
+            for guard in guarded_matches.keys():
+                if not guard.viable:
+                    del guarded_matches[guard]
+        return await_
+
+    def enabled(self):
+        # Events as tuples of process ids: (sender, receiver) for a rendezvous, (process,) for anything else
+        builder = self.builder
+        events = []
+        for process_id, await_ in self._pending.iteritems():
+            if isinstance(await_, AwaitOutput):
+                dest_process = await_.dest_process
+                if not dest_process.active:
+                    events.append((process_id,))
+                    continue
+                if self._accepts(builder.process_id(dest_process), await_.source_process, await_.value):
+                    events.append((process_id, builder.process_id(dest_process)))
+            elif isinstance(await_, AwaitInput):
+                viable = [guard for guard in await_.guarded_matches if guard.viable]
+                # A timeout without a delay only fires when something outside the network interrupts it
+                if not viable or any(isinstance(guard, InputGuard) and guard.source_process is None and
+                                     not (isinstance(guard, TimeoutGuard) and guard.delay is None)
+                                     for guard in viable):
+                    events.append((process_id,))
+                # Output guards offered to a process whose command accepts them; the rendezvous the other way
+                # round are found from the sending side
+                for guard in viable:
+                    if isinstance(guard, OutputGuard):
+                        dest_id = builder.process_id(guard.dest_process)
+                        if self._accepts(dest_id, await_.dest_process, guard.value):
+                            events.append((process_id, dest_id))
+            else:
+                events.append((process_id,))
+        return sorted(self._by_priority(set(events)))
+
+    def _is_priority(self, process_id):
+        await_ = self._pending.get(process_id)
+        return isinstance(await_, AwaitInput) and await_.priority
+
+    def _rank(self, process_id, partner_id):
+        # Position of the first guard of a priority alternation that the rendezvous with partner would take
+        await_ = self._pending[process_id]
+        process, partner = await_.dest_process, self.builder.process(partner_id)
+        partner_await = self._pending[partner_id]
+        if isinstance(partner_await, AwaitOutput):
+            offered = [partner_await.value] if partner_await.dest_process is process else []
+        else:
+            offered = [guard.value for guard in partner_await.guarded_matches
+                       if isinstance(guard, OutputGuard) and guard.dest_process is process]
+        for rank, guard in enumerate(await_.guarded_matches):
+            if isinstance(guard, OutputGuard):
+                if guard.dest_process is partner and self._accepts(partner_id, process, guard.value):
+                    return rank
+            elif guard.source_process is partner and any(guard.matches(partner, value) for value in offered):
+                return rank
+        return None
+
+    def _by_priority(self, events):
+        # A priority alternation only takes its highest ready guard, so its other rendezvous are not enabled
+        ranks = {}
+        for event in events:
+            if len(event) == 2:
+                for process_id, partner_id in (event, event[::-1]):
+                    if self._is_priority(process_id):
+                        ranks[event, process_id] = self._rank(process_id, partner_id)
+        best = {}
+        for (event, process_id), rank in ranks.iteritems():
+            best[process_id] = min(rank, best.get(process_id, rank))
+        return [event for event in events
+                if all(ranks[event, process_id] == best[process_id] for process_id in event if (event, process_id) in ranks)]
+
+    def _accepts(self, process_id, source_process, value):
+        await_ = self._pending.get(process_id)
+        return isinstance(await_, AwaitInput) and any(
+            input_guard.matches(source_process, value) for input_guard in await_.guarded_matches)
+
+    def potential_events(self):
+        # Every rendezvous a pending command names, whether or not the partner's current command accepts it
+        builder = self.builder
+        events = set()
+        for process_id, await_ in self._pending.iteritems():
+            if isinstance(await_, AwaitOutput):
+                events.add((process_id, builder.process_id(await_.dest_process)))
+            elif isinstance(await_, AwaitInput):
+                for guard in await_.guarded_matches:
+                    if isinstance(guard, OutputGuard):
+                        events.add((process_id, builder.process_id(guard.dest_process)))
+                    elif guard.source_process is not None:
+                        events.add((builder.process_id(guard.source_process), process_id))
+        return events
+
+    def step(self, event):
+        # Returns the ids of the processes the event touched
+        touched = set(event)
+        if len(event) == 2:
+            sender_id, receiver_id = event
+            # Input first: nothing else is posted, so it blocks until the output arrives and matches it
+            self.controller.post(self._prune(self._pending.pop(receiver_id)))
+            self.controller.post(self._prune(self._pending.pop(sender_id)))
+        else:
+            await_ = self._prune(self._pending.pop(event[0]))
+            self.controller.post(await_)
+            if isinstance(await_, AwaitInput):
+                self.controller.network.expire_timeout(await_.dest_process)
+        self._settle(touched)
+        self.schedule += (event,)
+        return frozenset(touched)
+
+    @property
+    def deadlocked(self):
+        return bool(self.controller.active_processes)
+
+    def fingerprint(self):
+        freezer = _Freezer(self.builder)
+        state = []
+        for process_id, process in enumerate(self.builder.processes):
+            if not process.active:
+                continue
+            frame = self.controller.process_runner(process).gi_frame
+            frame_state = None if frame is None else (frame.f_lasti, freezer.freeze(frame.f_locals))
+            state.append((process_id, frame_state, freezer.freeze(process.__dict__)))
+        # The frozen state is the key itself, so different states are never merged. Processes that draw random
+        # numbers diverge with the generator's state, so that is part of the key too, as a digest since it is large.
+        return tuple(state), hashlib.sha1(repr(random.getstate())).digest()
+
+
+def _type_name(type_):
+    return '{}.{}'.format(type_.__module__, type_.__name__)
+
+
+class _Freezer(object):
+    # Turns process state into something hashable and picklable, naming processes by id and types by name so that
+    # equal states from different replays, and from different worker processes, compare equal
+    MAX_DEPTH = 8
+    IGNORED_ATTRIBUTES = frozenset(['_controller', '_serial', '_channel_form', '_implied'])
+
+    def __init__(self, builder):
+        self._builder = builder
+
+    def freeze(self, value, depth=0):
+        if value is None or isinstance(value, (bool, int, long, float, basestring)):
+            return value
+        if isinstance(value, type):
+            return 'type', _type_name(value)
+        if isinstance(value, Process):
+            return 'process', self._builder.process_id(value)
+        if depth >= self.MAX_DEPTH:
+            return _type_name(type(value))
+        depth += 1
+        if isinstance(value, (InputGuard, OutputGuard)):
+            return 'guard', self.freeze(value.__dict__, depth)
+        if isinstance(value, tuple):
+            return _type_name(type(value)), tuple(self.freeze(item, depth) for item in value)
+        if isinstance(value, bytearray):
+            return 'bytearray', str(value)
+        if isinstance(value, (list, deque)):
+            return 'list', tuple(self.freeze(item, depth) for item in value)
+        if isinstance(value, (set, frozenset)):
+            return 'set', frozenset(self.freeze(item, depth) for item in value)
+        if isinstance(value, dict):
+            return 'dict', frozenset((self.freeze(key, depth), self.freeze(item, depth))
+                                   for key, item in value.iteritems() if key not in self.IGNORED_ATTRIBUTES)
+        if isinstance(value, (types.MethodType, types.FunctionType)):
+            return 'function', value.__name__
+        if isinstance(value, types.GeneratorType):
+            return 'generator', None if value.gi_frame is None else value.gi_frame.f_lasti
+        if hasattr(value, '__length_hint__') and iter(value) is value:
+            # Loop iterators only expose how far they have got through how much remains
+            return 'iterator', _type_name(type(value)), value.__length_hint__()
+        if hasattr(value, '__dict__'):
+            return _type_name(type(value)), self.freeze(value.__dict__, depth)
+        return _type_name(type(value))
+
+
+class _Node(object):
+    __slots__ = ('state', 'schedule', 'footprints', 'sleep', 'backtrack', 'done', 'taken', 'after', 'summary')
+
+    def __init__(self, state, schedule, footprints, sleep):
+        self.state = state
+        self.schedule = schedule
+        self.footprints = footprints
+        self.sleep = sleep
+        self.backtrack = set()
+        self.done = set()
+        self.taken = None
+        # Processes causally after the taken event, along the current path
+        self.after = None
+        # Footprints of every event taken anywhere below this state
+        self.summary = {}
+
+
+class _Visit(object):
+    __slots__ = ('sleep', 'depth', 'summary')
+
+    def __init__(self, sleep, depth):
+        self.sleep = sleep
+        self.depth = depth
+        self.summary = None
+
+
+class _SharedSubtrees(object):
+    # The states whose subtrees some search has finished, mapped to (sleep, summary), in a table the workers of a
+    # pool share. Final states are entered with an empty summary, so they are counted once.
+    def __init__(self, table):
+        self._table = table
+
+    def get(self, state):
+        return self._table.get(state)
+
+    def add(self, state, sleep, summary):
+        # Of two searches of a state, the one under the smaller sleep set covers more. Another worker may add the
+        # state in between, which only costs it the better of the two.
+        known = self._table.get(state)
+        if known is None or sleep < known[0]:
+            self._table[state] = sleep, summary
+
+
+class Explorer(object):
+    # Depth-first search of the interleavings of events in a network with dynamic partial order reduction: a
+    # state starts out exploring one event, and another ordering is only added when a later event shares a
+    # process with an earlier one that it is not causally after. Sleep sets skip reorderings already covered, and states
+    # are deduplicated by hash, with the footprints of a finished state's subtree replayed into the backtracking
+    # so pruning does not lose orderings. When one alternation could match several waiting senders the
+    # network's first match is taken; the other outcomes are reached through the schedules where those senders
+    # arrive in another order. Processes must behave deterministically given the schedule and the seed. known, a
+    # _SharedSubtrees, holds the subtrees other searches have finished: they are not searched again, and this
+    # search adds its own.
+    MAX_REPORTS = 10
+
+    def __init__(self, build, seed=0, max_depth=None, max_states=None, known=None):
+        self._build = build
+        self._seed = seed
+        self._max_depth = max_depth
+        self._max_states = max_states
+        self._known = known
+
+        self._visited = {}
+        # Final states, mapped to whether they are deadlocked
+        self._terminal = {}
+        self._execution = None
+        self._transitions = 0
+        self._completions = 0
+        self._deadlocks = []
+        # The final state of each reported deadlock
+        self._deadlocked = []
+        self._errors = []
+        self._truncated = 0
+
+    @property
+    def visited(self):
+        return frozenset(self._visited)
+
+    @property
+    def terminal(self):
+        return dict(self._terminal)
+
+    @property
+    def deadlocks(self):
+        # (final state, schedule) for each reported deadlock
+        return zip(self._deadlocked, self._deadlocks)
+
+    def result(self):
+        return ExplorationResult(len(self._visited), self._transitions, self._completions,
+                                 tuple(self._deadlocks), tuple(self._errors), self._truncated)
+
+    def _goto(self, schedule):
+        execution = self._execution
+        if execution is None or execution.schedule != schedule[:len(execution.schedule)]:
+            execution = self._execution = _Execution(self._build, self._seed)
+        for event in schedule[len(execution.schedule):]:
+            execution.step(event)
+        return execution
+
+    def _report(self, reports, item):
+        if len(reports) < self.MAX_REPORTS:
+            reports.append(item)
+
+    def _add_backtrack(self, stack, event, footprint):
+        # At every earlier event on the path that shares a process with this one while another participant of this
+        # one was not yet causally after it, the shared process could have met that participant instead. Unlike
+        # shared-memory DPOR it is not enough to look at the latest such event, since a rendezvous can be disabled
+        # by the partner's current command rather than only reordered.
+        participants = frozenset(event)
+        for node in stack:
+            taken_event, taken_footprint = node.taken
+            shared = taken_footprint & participants
+            if not shared:
+                continue
+            for other in participants - taken_footprint:
+                if other in node.after:
+                    continue
+                # Prefer that exact meeting, then anything moving the other participant towards it
+                alternatives = [alternative for alternative in node.footprints
+                                if other in alternative and shared.intersection(alternative)]
+                if not alternatives:
+                    alternatives = [alternative for alternative in node.footprints if other in alternative]
+                node.backtrack.update(alternatives)
+
+    def _reuse(self, stack, summary):
+        # The subtree below a state already searched: its events could follow the path here as well
+        for event, footprint in summary.iteritems():
+            self._add_backtrack(stack, event, footprint)
+        if stack:
+            self._merge_summary(stack[-1], summary)
+
+    def _merge_summary(self, node, summary):
+        for event, footprint in summary.iteritems():
+            node.summary[event] = node.summary.get(event, frozenset()) | footprint
+
+    def _enter(self, stack, schedule, sleep, frontier_depth, frontier):
+        execution = self._goto(schedule)
+        enabled = execution.enabled()
+        if not enabled:
+            for event in execution.potential_events():
+                self._add_backtrack(stack, event, frozenset(event))
+            state = execution.fingerprint()
+            if state in self._terminal:
+                return
+            if self._known is not None:
+                if self._known.get(state) is not None:
+                    # Already counted by another search
+                    return
+                self._known.add(state, frozenset(), {})
+            self._terminal[state] = execution.deadlocked
+            if execution.deadlocked:
+                if len(self._deadlocks) < self.MAX_REPORTS:
+                    self._deadlocked.append(state)
+                self._report(self._deadlocks, schedule)
+            else:
+                self._completions += 1
+            return
+
+        footprints = {event: frozenset(event) for event in enabled}
+        # Blocked rendezvous count too: the conflict that would have enabled them lies further up the path
+        for event in execution.potential_events().union(enabled):
+            self._add_backtrack(stack, event, frozenset(event))
+
+        state = execution.fingerprint()
+        visit = self._visited.get(state)
+        if visit is None and self._known is not None:
+            known = self._known.get(state)
+            if known is not None and known[0] <= frozenset(sleep):
+                self._reuse(stack, known[1])
+                return
+        if visit is not None:
+            if visit.summary is None:
+                # A cycle back to a state still being explored: its subtree is unknown, so be conservative
+                for node in stack[visit.depth:]:
+                    node.backtrack.update(node.footprints)
+                return
+            if visit.sleep <= frozenset(sleep):
+                self._reuse(stack, visit.summary)
+                return
+            visit.sleep &= frozenset(sleep)
+        elif self._max_states is not None and len(self._visited) >= self._max_states:
+            self._truncated += 1
+            return
+        else:
+            visit = self._visited[state] = _Visit(frozenset(sleep), len(stack))
+
+        if frontier is not None and len(schedule) >= frontier_depth:
+            # Left for a search elsewhere, once per state, under the sleep set of every path that reached it
+            if state in frontier:
+                schedule, earlier_sleep = frontier[state]
+                sleep = {event: footprint for event, footprint in earlier_sleep.iteritems() if event in sleep}
+            frontier[state] = schedule, sleep
+            visit.summary = {}
+            return
+        if self._max_depth is not None and len(schedule) >= self._max_depth:
+            self._truncated += 1
+            visit.summary = {}
+            return
+
+        node = _Node(state, schedule, footprints, sleep)
+        awake = [event for event in enabled if event not in sleep]
+        if frontier is not None:
+            # Above the split every awake event is taken, since the subtrees searched elsewhere cannot backtrack
+            # here; sleep sets still prune the reorderings they cover
+            node.backtrack.update(awake)
+        elif awake:
+            node.backtrack.add(awake[0])
+        visit.depth = len(stack)
+        stack.append(node)
+
+    def _leave(self, stack):
+        node = stack.pop()
+        visit = self._visited[node.state]
+        visit.summary = node.summary
+        if self._known is not None:
+            self._known.add(node.state, visit.sleep, node.summary)
+        if stack:
+            self._merge_summary(stack[-1], node.summary)
+
+    def search(self, schedule=(), sleep=None, frontier_depth=None, frontier=None):
+        stack = []
+        self._enter(stack, schedule, sleep or {}, frontier_depth, frontier)
+        while stack:
+            node = stack[-1]
+            candidates = node.backtrack - node.done - set(node.sleep)
+            if not candidates:
+                self._leave(stack)
+                continue
+            event = min(candidates)
+            node.done.add(event)
+            execution = self._goto(node.schedule)
+            try:
+                footprint = execution.step(event)
+            except Exception as e:
+                self._report(self._errors, (node.schedule + (event,), repr(e)))
+                self._execution = None
+                continue
+            self._transitions += 1
+            node.taken = (event, footprint)
+            node.after = set(footprint)
+            for lower in stack[:-1]:
+                if lower.after & footprint:
+                    lower.after |= footprint
+            self._merge_summary(node, {event: footprint})
+
+            child_sleep = {}
+            for other in set(node.sleep) | node.done:
+                if other != event and not (node.footprints[other] & footprint):
+                    child_sleep[other] = node.footprints[other]
+            self._enter(stack, execution.schedule, child_sleep, frontier_depth, frontier)
+        return self.result()
+
+
+# Set in each worker of the pool by _init_worker: (build, seed, max_depth, max_states, known)
+_worker = None
+
+
+def _init_worker(build, seed, max_depth, max_states, table):
+    global _worker
+    _worker = build, seed, max_depth, max_states, _SharedSubtrees(table)
+
+
+def _search_subtree(task):
+    build, seed, max_depth, max_states, known = _worker
+    schedule, sleep = task
+    explorer = Explorer(build, seed, max_depth, max_states, known)
+    return explorer.search(schedule, sleep), explorer.visited, explorer.terminal, explorer.deadlocks
+
+
+def explore(build, seed=0, workers=None, max_depth=None, max_states=None, split_depth=4):
+    # build(controller) creates and wires the processes, as dining_philosophers.build does. With workers the
+    # search stops split_depth events in, leaving each state it reaches there on a frontier once, and the
+    # subtrees below the frontier are searched in a process pool; build must then be picklable, e.g. a module level
+    # function or a functools.partial of one. The workers are given the search's parameters once, when they start,
+    # and share a table of finished subtrees through a manager, so a state one of them has searched is not
+    # searched again by another.
+    if not workers or workers <= 1:
+        return Explorer(build, seed, max_depth, max_states).search()
+
+    explorer = Explorer(build, seed, max_depth, max_states)
+    frontier = {}
+    top = explorer.search(frontier_depth=split_depth, frontier=frontier)
+    visited, terminal = set(explorer.visited), explorer.terminal
+    transitions, truncated = top.transitions, top.truncated
+    deadlocks, errors = dict(explorer.deadlocks), list(top.errors)
+
+    manager = Manager()
+    try:
+        pool = Pool(workers, initializer=_init_worker,
+                    initargs=(build, seed, max_depth, max_states, manager.dict()))
+        try:
+            for result, subtree_visited, subtree_terminal, subtree_deadlocks in pool.imap_unordered(
+                    _search_subtree, frontier.values()):
+                visited |= subtree_visited
+                # Subtrees can reach the same final states, so completions are counted once the states are merged
+                terminal.update(subtree_terminal)
+                transitions += result.transitions
+                truncated += result.truncated
+                for state, schedule in subtree_deadlocks:
+                    if state not in deadlocks and len(deadlocks) < Explorer.MAX_REPORTS:
+                        deadlocks[state] = schedule
+                errors.extend(result.errors[:Explorer.MAX_REPORTS - len(errors)])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        manager.shutdown()
+
+    completions = sum(1 for deadlocked in terminal.itervalues() if not deadlocked)
+    return ExplorationResult(len(visited), transitions, completions, tuple(sorted(deadlocks.itervalues())),
+                             tuple(errors), truncated)
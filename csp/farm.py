@@ -0,0 +1,166 @@
+from collections import deque, namedtuple
+from functools import partial
+from timeit import default_timer
+
+from papers.csp.controller import Controller, SequentialDispatcher, NaiveNetwork
+from papers.csp.exercises import OffloadedDivMod, DivMod, PipelinedDivModRunner
+from papers.csp.io_semantics import InputGuard, OutputGuard, CommandFailure
+from papers.csp.offload import Offloader
+from papers.csp.process import Process, AwaitInput
+
+
+WorkerUtilization = namedtuple('WorkerUtilization', ['served', 'stolen', 'busy_time', 'utilization'])
+
+
+class _Request(object):
+    __slots__ = ('caller', 'sequence', 'value')
+
+    def __init__(self, caller, sequence, value):
+        self.caller = caller
+        self.sequence = sequence
+        self.value = value
+
+
+class Farm(Process):
+    # A dispatcher in front of identical request/response workers. Each caller sees a single worker that may be
+    # sent several requests before reading the replies, which come back in the order the caller asked; the farm
+    # assigns each request to the worker with the shortest queue, and a worker that runs dry steals from the back
+    # of the longest queue. A worker is only sent a request when idle, so its queue is the farm's.
+    def __init__(self, controller, max_outstanding=None):
+        super(Farm, self).__init__(controller)
+        self._callers = []
+        self._workers = []
+        self._max_outstanding = max_outstanding
+
+        self._queues = []
+        self._busy = []
+        self._served = []
+        self._stolen = []
+        self._busy_time = []
+        self._started = None
+        self._finished = None
+
+    @property
+    def workers(self):
+        return tuple(self._workers)
+
+    def add_caller(self, process):
+        self._callers.append(process)
+        self.register_inputs(process)
+        self.register_outputs(process)
+
+    def add_worker(self, process):
+        self._workers.append(process)
+        self.register_inputs(process)
+        self.register_outputs(process)
+        self._queues.append(deque())
+        self._busy.append(None)
+        self._served.append(0)
+        self._stolen.append(0)
+        self._busy_time.append(0.0)
+
+    @property
+    def _is_run_ready(self):
+        return bool(self._callers) and bool(self._workers)
+
+    def utilization(self):
+        # Per worker, in the order added; utilization is the fraction of the farm's lifetime spent with a request
+        elapsed = (self._finished or default_timer()) - self._started if self._started is not None else 0.0
+        return [WorkerUtilization(served, stolen, busy_time, busy_time / elapsed if elapsed else 0.0)
+                for served, stolen, busy_time in zip(self._served, self._stolen, self._busy_time)]
+
+    def _assign(self, request):
+        index = min(xrange(len(self._workers)),
+                    key=lambda i: (len(self._queues[i]) + (self._busy[i] is not None), i))
+        self._queues[index].append(request)
+
+    def _stealable(self, index):
+        # An idle worker's head request is about to be sent to it, so only what is queued behind a request is taken
+        return len(self._queues[index]) - (self._busy[index] is None)
+
+    def _steal(self, index):
+        victim = max(xrange(len(self._workers)), key=lambda i: (self._stealable(i), -i))
+        if victim != index and self._stealable(victim) > 0:
+            self._queues[index].append(self._queues[victim].pop())
+            self._stolen[index] += 1
+
+    def _run(self):
+        self._started = default_timer()
+        next_sequence = {caller: 0 for caller in self._callers}
+        next_reply = {caller: 0 for caller in self._callers}
+        replies = {caller: {} for caller in self._callers}
+        outstanding = [0]
+
+        def accept(caller, value):
+            self._assign(_Request(caller, next_sequence[caller], value))
+            next_sequence[caller] += 1
+            outstanding[0] += 1
+
+        def sent(index, _):
+            self._busy[index] = (self._queues[index].popleft(), default_timer())
+
+        def received(index, value):
+            request, started = self._busy[index]
+            self._busy[index] = None
+            self._busy_time[index] += default_timer() - started
+            self._served[index] += 1
+            replies[request.caller][request.sequence] = value
+
+        def replied(caller, _):
+            del replies[caller][next_reply[caller]]
+            next_reply[caller] += 1
+            outstanding[0] -= 1
+
+        while True:
+            for index in xrange(len(self._workers)):
+                if self._busy[index] is None and not self._queues[index]:
+                    self._steal(index)
+
+            accepting = self._max_outstanding is None or outstanding[0] < self._max_outstanding
+            guarded_matches = {}
+            for caller in self._callers:
+                guarded_matches[InputGuard(caller, boolean_result=accepting)] = partial(accept, caller)
+                if next_reply[caller] in replies[caller]:
+                    reply = replies[caller][next_reply[caller]]
+                    guarded_matches[OutputGuard(caller, reply)] = partial(replied, caller)
+            for index, worker in enumerate(self._workers):
+                if self._busy[index] is not None:
+                    guarded_matches[InputGuard(worker)] = partial(received, index)
+                elif self._queues[index]:
+                    guarded_matches[OutputGuard(worker, self._queues[index][0].value)] = partial(sent, index)
+
+            if not any(guard.viable for guard in guarded_matches) and not outstanding[0]:
+                # Every caller has gone and nothing is owed, so the workers can be let go
+                break
+            try:
+                yield self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+            except CommandFailure:
+                break
+        self._finished = default_timer()
+
+
+def run(num_workers=4, offload=True):
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+    offloader = Offloader(controller, num_workers) if offload else None
+
+    problems = [(10 ** 6 * (i % 3 + 1), 7 + i) for i in range(12)]
+    runner = PipelinedDivModRunner(controller, problems)
+    farm = Farm(controller)
+    farm.add_caller(runner)
+    runner.set_worker('farm', farm)
+    for _ in range(num_workers):
+        worker = (OffloadedDivMod if offload else DivMod)(controller)
+        worker.set_caller(farm)
+        farm.add_worker(worker)
+
+    controller.wire()
+    try:
+        controller.run()
+    finally:
+        if offloader is not None:
+            offloader.close()
+
+    for index, utilization in enumerate(farm.utilization()):
+        print('worker {}: {}'.format(index, utilization))
@@ -0,0 +1,233 @@
+import errno
+import fcntl
+import math
+import os
+import select
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.exercises import Copy
+from papers.csp.io_semantics import InputGuard, CommandFailure
+from papers.csp.process import AwaitIo, SingleOutputProcess, SingleInputProcess
+
+
+def _set_nonblocking(fd):
+    # Returns the flags as they were
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return flags
+
+
+class IoPoller(object):
+    # Holds AwaitIo commands until their file descriptors are ready, then hands them to the network. The controller
+    # sleeps in wait() when nothing is ready to run; wake() (e.g. from the offloader's pool thread) interrupts it
+    # through a self-pipe. Uses poll(2) where the platform has it and select(2) otherwise.
+    def __init__(self, controller):
+        self._controller = controller
+
+        self._awaits_by_fd = {}
+        self._pending = 0
+        self._wake_read, self._wake_write = os.pipe()
+        _set_nonblocking(self._wake_read)
+        _set_nonblocking(self._wake_write)
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+        if self._poll is not None:
+            self._poll.register(self._wake_read, select.POLLIN)
+
+        controller.set_poller(self)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _mask(self, fd):
+        mask = 0
+        for await_ in self._awaits_by_fd.get(fd, ()):
+            mask |= select.POLLIN if await_.direction == AwaitIo.READ else select.POLLOUT
+        return mask
+
+    def _update(self, fd):
+        if self._poll is None:
+            return
+        mask = self._mask(fd)
+        if mask:
+            self._poll.register(fd, mask)
+        else:
+            self._poll.unregister(fd)
+
+    def submit(self, await_):
+        self._awaits_by_fd.setdefault(await_.fd, []).append(await_)
+        self._pending += 1
+        self._update(await_.fd)
+
+    def wake(self):
+        try:
+            os.write(self._wake_write, b'\0')
+        except OSError as e:
+            # A full pipe already has a wakeup waiting
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _select(self, timeout):
+        # Ready (fd, readable, writable, failed) tuples; timeout in seconds, None to block. A descriptor that has
+        # been closed or is in error is failed, rather than reported ready again on every call.
+        if self._poll is not None:
+            # Rounded up, since a timeout rounded down to 0 near a deadline would spin until it passed
+            events = self._poll.poll(None if timeout is None else int(math.ceil(max(timeout, 0) * 1000)))
+            return [(fd, bool(mask & (select.POLLIN | select.POLLHUP)),
+                     bool(mask & (select.POLLOUT | select.POLLHUP)),
+                     bool(mask & (select.POLLERR | select.POLLNVAL))) for fd, mask in events]
+
+        readers = [self._wake_read]
+        writers = []
+        for fd, awaits in self._awaits_by_fd.iteritems():
+            if any(await_.direction == AwaitIo.READ for await_ in awaits):
+                readers.append(fd)
+            if any(await_.direction == AwaitIo.WRITE for await_ in awaits):
+                writers.append(fd)
+        try:
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EBADF:
+                raise
+            return [(fd, False, False, True) for fd in self._awaits_by_fd if not self._is_open(fd)]
+        ready = dict((fd, [True, False]) for fd in readable)
+        for fd in writable:
+            ready.setdefault(fd, [False, False])[1] = True
+        return [(fd, readable_, writable_, False) for fd, (readable_, writable_) in ready.iteritems()]
+
+    @staticmethod
+    def _is_open(fd):
+        try:
+            os.fstat(fd)
+        except OSError:
+            return False
+        return True
+
+    def _dispatch(self, ready):
+        dispatched = 0
+        for fd, readable, writable, failed in ready:
+            if fd == self._wake_read:
+                self._drain_wakeups()
+                continue
+            awaits = self._awaits_by_fd.get(fd)
+            if not awaits:
+                continue
+            remaining = []
+            for await_ in awaits:
+                if failed:
+                    await_.origin_process.fail_await()
+                    self._controller.add_ready(await_)
+                    dispatched += 1
+                elif readable if await_.direction == AwaitIo.READ else writable:
+                    self._controller.add_ready(await_)
+                    dispatched += 1
+                else:
+                    remaining.append(await_)
+            if remaining:
+                self._awaits_by_fd[fd] = remaining
+            else:
+                del self._awaits_by_fd[fd]
+            self._update(fd)
+        self._pending -= dispatched
+        return dispatched
+
+    def poll(self):
+        return self._dispatch(self._select(0))
+
+    def wait(self, timeout=None):
+        # Sleep until a descriptor is ready, a wakeup arrives or the timeout passes
+        return self._dispatch(self._select(timeout))
+
+    def close(self):
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+
+class FdReader(SingleOutputProcess):
+    # Fronts a readable file descriptor: outputs each chunk read from it until end of file
+    def __init__(self, controller, fileobj, chunk_size=4096):
+        super(FdReader, self).__init__(controller)
+        self._fd = fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+        self._chunk_size = chunk_size
+
+    def _run(self):
+        while True:
+            try:
+                yield self.await_readable(self._fd)
+            except CommandFailure:
+                break
+            try:
+                chunk = os.read(self._fd, self._chunk_size)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                raise
+            if not chunk:
+                break
+            try:
+                yield self.await_output(self._output_process, chunk)
+            except CommandFailure:
+                break
+
+
+class FdWriter(SingleInputProcess):
+    # Writes everything it receives to a writable file descriptor, without blocking the rest of the network. A
+    # descriptor reported writable can still block on a write larger than the room it has, so it is made
+    # non-blocking while the writer runs and its flags are put back when it finishes.
+    def __init__(self, controller, fileobj):
+        super(FdWriter, self).__init__(controller)
+        self._fd = fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+
+    def _run(self):
+        flags = _set_nonblocking(self._fd)
+        try:
+            while True:
+                try:
+                    _, data = yield self.await_input(InputGuard.single_match(self._input_process))
+                except CommandFailure:
+                    break
+                while data:
+                    try:
+                        yield self.await_writable(self._fd)
+                    except CommandFailure:
+                        # Closed or in error, so nothing more can be written
+                        return
+                    try:
+                        written = os.write(self._fd, data)
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        raise
+                    data = data[written:]
+        finally:
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, flags)
+
+
+def run(fd_in=0, fd_out=1):
+    # Copies standard input to standard output through a Copy process
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+    poller = IoPoller(controller)
+
+    reader = FdReader(controller, fd_in)
+    copy = Copy(controller)
+    writer = FdWriter(controller, fd_out)
+    reader.set_output(copy)
+    copy.set_input(reader)
+    copy.set_output(writer)
+    writer.set_input(copy)
+
+    controller.wire()
+    try:
+        controller.run()
+    finally:
+        poller.close()
@@ -1,3 +1,6 @@
+from copy import deepcopy
+
+
 class CommandFailure(Exception):
     pass
 
@@ -17,12 +20,43 @@ class NTuple(object):
         return self._length
 
 
+def form_matches(form, value):
+    if form is None:
+        return True
+    if isinstance(form, NTuple):
+        return isinstance(value, tuple) and len(value) == form.length
+    return isinstance(value, form)
+
+
+def form_implies(declared, form):
+    # Whether every value matching declared also matches form, in which case a value known to match declared need not
+    # be checked against form
+    if form is None:
+        return True
+    if declared is None:
+        return False
+    if isinstance(form, NTuple):
+        if isinstance(declared, NTuple):
+            return declared.length == form.length
+        # A namedtuple has a fixed length
+        return issubclass(declared, tuple) and hasattr(declared, '_fields') and len(declared._fields) == form.length
+    if isinstance(declared, NTuple):
+        return issubclass(tuple, form)
+    return issubclass(declared, form)
+
+
 class InputGuard(object):
     def __init__(self, source_process, form=None, boolean_result=True):
         self._form = form
         self._source_process = source_process
         # None indicates it is a guard without an input process, so purely conditional
         self._boolean_result = boolean_result
+        # The channel form the guard's form was last checked against, and whether it implies it
+        self._channel_form = None
+        self._implied = False
+
+    def __hash__(self):
+        return hash(self._source_process)
 
     @classmethod
     def single_match(cls, source_process, form=None, boolean_result=True):
@@ -36,7 +70,9 @@ class InputGuard(object):
     def source_process(self):
         return self._source_process
 
-    def matches(self, source_process, value):
+    def matches(self, source_process, value, channel_form=None):
+        # channel_form is the form declared for the channel the value came over, if any; values are only checked
+        # against the guard's own form when that does not already vouch for them
         if not self.viable:
             return False
 
@@ -45,9 +81,69 @@ class InputGuard(object):
 
         if self._form is None:
             return True
-        if isinstance(self._form, NTuple):
-            return isinstance(value, tuple) and len(value) == self._form.length
-        return isinstance(value, self._form)
+        if channel_form is not None:
+            if channel_form is not self._channel_form:
+                self._channel_form = channel_form
+                self._implied = form_implies(channel_form, self._form)
+            if self._implied:
+                return True
+        return form_matches(self._form, value)
+
+
+class OutputGuard(object):
+    # dest_process!value as a guard: goes in the same alternations as input guards, and when it is chosen the value
+    # has been sent and its branch receives None
+    def __init__(self, dest_process, value, boolean_result=True):
+        self._dest_process = dest_process
+        self._value = deepcopy(value)
+        self._boolean_result = boolean_result
+
+    def __hash__(self):
+        return hash(self._dest_process)
+
+    @classmethod
+    def single_match(cls, dest_process, value, boolean_result=True):
+        return {cls(dest_process, value, boolean_result): 'the'}
+
+    @property
+    def viable(self):
+        return self._boolean_result and self._dest_process.active
+
+    @property
+    def dest_process(self):
+        return self._dest_process
+
+    @property
+    def value(self):
+        return self._value
+
+    def matches(self, source_process, value, channel_form=None):
+        # Takes no input
+        return False
+
+
+class TimeoutGuard(InputGuard):
+    # Fires when no other guard of its alternation has matched within delay seconds of the alternation being
+    # reached; it takes no input, so its branch receives None. With only timeout guards left the alternation is
+    # a sleep rather than a failure. With a delay of None it never fires by itself, only when the network is told
+    # to interrupt the alternation.
+    def __init__(self, delay):
+        super(TimeoutGuard, self).__init__(None)
+        self._delay = delay
+
+    def __hash__(self):
+        return hash(self._delay)
+
+    @property
+    def delay(self):
+        return self._delay
+
+    @property
+    def viable(self):
+        return True
+
+    def matches(self, source_process, value, channel_form=None):
+        return False
 
 
 class Return(Exception):
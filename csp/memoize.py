@@ -0,0 +1,174 @@
+from collections import OrderedDict
+
+from papers.csp.controller import Controller, SequentialDispatcher, NaiveNetwork
+from papers.csp.exercises import DivMod, DivModRunner, Factorial, FactorialRunner, FailProcess
+from papers.csp.io_semantics import InputGuard, CommandFailure
+from papers.csp.process import SimpleAsyncWorkerProcess
+
+
+class LruCache(object):
+    # Bounded by entry count and, given weigh(key, value), by total weight; the least recently used entries go first
+    def __init__(self, max_entries=1024, max_weight=None, weigh=None):
+        assert max_entries is None or max_entries > 0
+        assert max_weight is None or weigh is not None
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_weight = max_weight
+        self._weigh = weigh
+        self._weights = {}
+        self._weight = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            del self._entries[key]
+            self._weight -= self._weights.pop(key, 0)
+        if self._weigh is not None:
+            weight = self._weigh(key, value)
+            if self._max_weight is not None and weight > self._max_weight:
+                # Would evict everything and still not fit
+                return
+            self._weights[key] = weight
+            self._weight += weight
+        self._entries[key] = value
+        self._evict()
+
+    def _evict(self):
+        while ((self._max_entries is not None and len(self._entries) > self._max_entries) or
+               (self._max_weight is not None and self._weight > self._max_weight)):
+            key, _ = self._entries.popitem(last=False)
+            self._weight -= self._weights.pop(key, 0)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._weights.clear()
+        self._weight = 0
+
+    def __repr__(self):
+        return 'LruCache(entries={}, weight={}, hits={}, misses={}, evictions={}, hit_ratio={:.3f})'.format(
+            len(self._entries), self._weight, self.hits, self.misses, self.evictions, self.hit_ratio)
+
+
+class Memoizer(SimpleAsyncWorkerProcess):
+    # Stands in for a request/response worker, answering requests it has seen from the cache and forwarding the
+    # rest. The worker must reply exactly once per request and its answers must only depend on the request.
+    def __init__(self, controller, cache=None, key=None):
+        super(Memoizer, self).__init__(controller)
+        self._cache = LruCache() if cache is None else cache
+        self._key = key
+        self._worker_process = None
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def worker_process(self):
+        return self._worker_process
+
+    def set_worker(self, process):
+        self._worker_process = process
+        self.register_inputs(process)
+        self.register_outputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return self._caller_process is not None and self._worker_process is not None
+
+    def _run(self):
+        missing = object()
+        while True:
+            try:
+                _, request = yield self.await_input(InputGuard.single_match(self._caller_process))
+                key = request if self._key is None else self._key(request)
+                response = self._cache.get(key, missing)
+                if response is missing:
+                    yield self.await_output(self._worker_process, request)
+                    _, response = yield self.await_input(InputGuard.single_match(self._worker_process))
+                    self._cache.put(key, response)
+                yield self.await_output(self._caller_process, response)
+            except CommandFailure:
+                break
+
+
+def ex_4_1_memoized():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    divmod_ = DivMod(controller)
+    memoizer = Memoizer(controller, LruCache(max_entries=2))
+    divmod_runner = DivModRunner(controller, [(22, 7), (81, 9), (22, 7), (10, 1), (81, 9), (22, 7)])
+    divmod_.set_caller(memoizer)
+    memoizer.set_worker(divmod_)
+    memoizer.set_caller(divmod_runner)
+    divmod_runner.set_worker('divmod', memoizer)
+
+    controller.wire()
+    controller.run()
+
+    print(memoizer.cache)
+
+
+def ex_4_2_memoized():
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    inputs = [9, 12, 9, 0, 12, 7, 9, 12]
+    num_nodes = max(inputs) + 1
+
+    runner = FactorialRunner(controller, inputs)
+    memoizer = Memoizer(controller)
+    memoizer.set_caller(runner)
+    runner.set_worker('factorial', memoizer)
+
+    factorial_nodes = [Factorial(controller) for _ in range(num_nodes)]
+    fail = FailProcess(controller)
+    for i in range(num_nodes):
+        if i == 0:
+            factorial_nodes[i].set_previous_process(memoizer)
+            memoizer.set_worker(factorial_nodes[i])
+        else:
+            factorial_nodes[i].set_previous_process(factorial_nodes[i - 1])
+
+        if i == num_nodes - 1:
+            factorial_nodes[i].set_next_process(fail)
+            fail.add_input_process(factorial_nodes[i])
+            fail.register_outputs(factorial_nodes[i])
+        else:
+            factorial_nodes[i].set_next_process(factorial_nodes[i + 1])
+
+    controller.wire()
+    controller.run()
+
+    print(memoizer.cache)
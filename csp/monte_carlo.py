@@ -0,0 +1,153 @@
+import os
+import random
+import sys
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import Pool
+from timeit import default_timer
+
+from papers.csp import dining_philosophers
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher, DeadlockError
+
+
+COMPLETED = 'completed'
+DEADLOCK = 'deadlock'
+ERROR = 'error'
+
+RunResult = namedtuple('RunResult', ['seed', 'params', 'outcome', 'steps', 'blocked_inputs', 'blocked_outputs',
+                                     'elapsed', 'error'])
+
+
+def run_once(build, seed, params=()):
+    # build(controller, **params) creates the processes, as dining_philosophers.build does. The schedule only
+    # depends on the global random state, so seeding it makes the run reproducible.
+    random.seed(seed)
+    controller = Controller()
+    network = NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    start = default_timer()
+    error = None
+    try:
+        build(controller, **dict(params))
+        controller.wire()
+        controller.run()
+        outcome = COMPLETED
+    except DeadlockError:
+        outcome = DEADLOCK
+    except Exception as e:
+        outcome = ERROR
+        error = repr(e)
+    elapsed = default_timer() - start
+
+    return RunResult(seed, params, outcome, controller.steps, network.blocked_inputs, network.blocked_outputs,
+                     elapsed, error)
+
+
+def _run_task(args):
+    return run_once(*args)
+
+
+def _quiet():
+    # Examples print as they go; thousands of runs should not
+    sys.stdout = open(os.devnull, 'w')
+
+
+@contextmanager
+def _quieted():
+    # _quiet for the duration only, for runs in this process
+    stdout = sys.stdout
+    _quiet()
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class Summary(object):
+    # Running aggregate of RunResults, so results can be folded in as they arrive rather than kept
+    def __init__(self):
+        self.runs = 0
+        self.outcomes = {COMPLETED: 0, DEADLOCK: 0, ERROR: 0}
+        self.total_steps = 0
+        self.min_steps = None
+        self.max_steps = None
+        self.total_blocked = 0
+        self.total_elapsed = 0.0
+        self.deadlock_seeds = []
+        self.errors = []
+
+    def add(self, result):
+        self.runs += 1
+        self.outcomes[result.outcome] += 1
+        self.total_steps += result.steps
+        self.min_steps = result.steps if self.min_steps is None else min(self.min_steps, result.steps)
+        self.max_steps = result.steps if self.max_steps is None else max(self.max_steps, result.steps)
+        self.total_blocked += result.blocked_inputs + result.blocked_outputs
+        self.total_elapsed += result.elapsed
+        if result.outcome == DEADLOCK:
+            self.deadlock_seeds.append(result.seed)
+        elif result.outcome == ERROR:
+            self.errors.append((result.seed, result.error))
+
+    @property
+    def mean_steps(self):
+        return float(self.total_steps) / self.runs if self.runs else 0.0
+
+    @property
+    def mean_elapsed(self):
+        return self.total_elapsed / self.runs if self.runs else 0.0
+
+    @property
+    def blocked_ratio(self):
+        # Fraction of steps that ended in a command having to wait for its partner
+        return float(self.total_blocked) / self.total_steps if self.total_steps else 0.0
+
+    def __repr__(self):
+        return ('Summary(runs={}, completed={}, deadlock={}, error={}, steps={:.1f} [{}, {}], blocked={:.3f}, '
+                'elapsed={:.4f}s)').format(self.runs, self.outcomes[COMPLETED], self.outcomes[DEADLOCK],
+                                           self.outcomes[ERROR], self.mean_steps, self.min_steps, self.max_steps,
+                                           self.blocked_ratio, self.mean_elapsed)
+
+
+def iter_runs(build, seeds, params=({},), workers=None, chunksize=16, quiet=True):
+    # Runs every combination of seed and params, yielding RunResults as they complete (in no particular order).
+    # Workers are forked once and run many instances each; build must be picklable, e.g. a module level function.
+    seeds = list(seeds)
+    tasks = ((build, seed, tuple(sorted(p.iteritems()))) for p in params for seed in seeds)
+    if workers == 1:
+        for task in tasks:
+            if quiet:
+                with _quieted():
+                    result = _run_task(task)
+            else:
+                result = _run_task(task)
+            yield result
+        return
+
+    pool = Pool(workers, initializer=_quiet if quiet else None)
+    try:
+        for result in pool.imap_unordered(_run_task, tasks, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def simulate(build, seeds, params=({},), workers=None, chunksize=16, quiet=True):
+    # Summaries keyed by params, as a sorted tuple of items
+    summaries = {}
+    for result in iter_runs(build, seeds, params, workers, chunksize, quiet):
+        summary = summaries.get(result.params)
+        if summary is None:
+            summary = summaries[result.params] = Summary()
+        summary.add(result)
+    return summaries
+
+
+def run(runs=1000, workers=None):
+    summaries = simulate(dining_philosophers.build, xrange(runs),
+                         [{'seats': 5, 'lifespan': lifespan} for lifespan in (1, 10, 100)], workers)
+    for params, summary in sorted(summaries.iteritems()):
+        print('{}: {}'.format(dict(params), summary))
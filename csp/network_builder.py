@@ -0,0 +1,225 @@
+from array import array
+from bisect import bisect_left
+
+
+class CsrAdjacency(object):
+    # Compressed sparse rows: the neighbours of process i are the ids indices[indptr[i]:indptr[i + 1]], sorted.
+    # Removal only clears liveness flags; compacted() rebuilds the arrays without the removed entries.
+    def __init__(self, processes, ids_by_process, indptr, indices):
+        self._processes = processes
+        self._ids_by_process = ids_by_process
+        self._indptr = indptr
+        self._indices = indices
+        self._row_alive = bytearray('\x01') * len(processes)
+        self._edge_alive = bytearray('\x01') * len(indices)
+
+    @classmethod
+    def from_keys(cls, processes, ids_by_process, keys):
+        # keys are sorted, unique row * len(processes) + column encodings of the edges
+        n = len(processes)
+        indptr = array('l', (bisect_left(keys, row * n) for row in xrange(n + 1)))
+        indices = array('l', (key % n for key in keys)) if n else array('l')
+        return cls(processes, ids_by_process, indptr, indices)
+
+    def _row(self, process):
+        process_id = self._ids_by_process.get(process)
+        if process_id is None or not self._row_alive[process_id]:
+            return None
+        return process_id
+
+    def __contains__(self, process):
+        return self._row(process) is not None
+
+    def __getitem__(self, process):
+        # Like defaultdict(set): processes without a row have no neighbours
+        return _CsrRow(self, self._row(process))
+
+    def pop(self, process, default=None):
+        row = self._row(process)
+        if row is None:
+            return default
+        neighbours = list(_CsrRow(self, row))
+        self._row_alive[row] = 0
+        return neighbours
+
+    def iteritems(self):
+        for row, process in enumerate(self._processes):
+            if self._row_alive[row]:
+                yield process, _CsrRow(self, row)
+
+    def has_edge(self, row, column):
+        lo, hi = self._indptr[row], self._indptr[row + 1]
+        position = bisect_left(self._indices, column, lo, hi)
+        return position < hi and self._indices[position] == column and bool(self._edge_alive[position])
+
+    def discard_edge(self, row, column):
+        lo, hi = self._indptr[row], self._indptr[row + 1]
+        position = bisect_left(self._indices, column, lo, hi)
+        if position < hi and self._indices[position] == column:
+            self._edge_alive[position] = 0
+
+    def compacted(self):
+        # Renumbers the live rows, so processes that have been popped are no longer referenced at all
+        live_rows = [row for row in xrange(len(self._processes)) if self._row_alive[row]]
+        new_ids = {row: new_id for new_id, row in enumerate(live_rows)}
+        processes = [self._processes[row] for row in live_rows]
+        n = len(processes)
+        keys = array('l')
+        for new_row, row in enumerate(live_rows):
+            for position in xrange(self._indptr[row], self._indptr[row + 1]):
+                column = new_ids.get(self._indices[position])
+                if self._edge_alive[position] and column is not None:
+                    keys.append(new_row * n + column)
+        return self.from_keys(processes, {process: new_id for new_id, process in enumerate(processes)}, keys)
+
+
+class _CsrRow(object):
+    __slots__ = ('_adjacency', '_row')
+
+    def __init__(self, adjacency, row):
+        self._adjacency = adjacency
+        self._row = row
+
+    def __contains__(self, process):
+        if self._row is None:
+            return False
+        column = self._adjacency._ids_by_process.get(process)
+        return column is not None and self._adjacency.has_edge(self._row, column)
+
+    def __iter__(self):
+        if self._row is None:
+            return
+        adjacency = self._adjacency
+        for position in xrange(adjacency._indptr[self._row], adjacency._indptr[self._row + 1]):
+            if adjacency._edge_alive[position]:
+                yield adjacency._processes[adjacency._indices[position]]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def discard(self, process):
+        column = self._adjacency._ids_by_process.get(process)
+        if self._row is not None and column is not None:
+            self._adjacency.discard_edge(self._row, column)
+
+
+class NetworkBuilder(object):
+    # Collects the wiring of a controller before wire() using dense integer process ids and flat edge arrays, then
+    # hands it to the network as CSR adjacency. Edges can also be added in bulk by id.
+    def __init__(self, controller):
+        self._controller = controller
+        controller.set_builder(self)
+
+        self._processes = []
+        self._ids_by_process = {}
+        # Edges as parallel id arrays: inputs are (receiver, sender), outputs are (sender, receiver)
+        self._input_rows = array('l')
+        self._input_columns = array('l')
+        self._output_rows = array('l')
+        self._output_columns = array('l')
+        self._neighbours = None
+
+    @property
+    def processes(self):
+        return tuple(self._processes)
+
+    def __len__(self):
+        return len(self._processes)
+
+    def process(self, process_id):
+        return self._processes[process_id]
+
+    def process_id(self, process):
+        return self._ids_by_process[process]
+
+    def neighbour_ids(self, process_id):
+        # Every process sharing a channel with the given one, in either direction
+        if self._neighbours is None:
+            self._neighbours = [set() for _ in self._processes]
+            for rows, columns in ((self._input_rows, self._input_columns), (self._output_rows, self._output_columns)):
+                for row, column in zip(rows, columns):
+                    self._neighbours[row].add(column)
+                    self._neighbours[column].add(row)
+        return self._neighbours[process_id]
+
+    def add_process(self, process):
+        self._neighbours = None
+        process_id = self._ids_by_process.get(process)
+        if process_id is None:
+            process_id = len(self._processes)
+            self._ids_by_process[process] = process_id
+            self._processes.append(process)
+        return process_id
+
+    def add_processes(self, processes):
+        return [self.add_process(process) for process in processes]
+
+    def add_process_input(self, receiver, sender):
+        self._input_rows.append(self.add_process(receiver))
+        self._input_columns.append(self.add_process(sender))
+
+    def add_process_output(self, sender, receiver):
+        self._output_rows.append(self.add_process(sender))
+        self._output_columns.append(self.add_process(receiver))
+
+    def _check_ids(self, *id_sequences):
+        n = len(self._processes)
+        for ids in id_sequences:
+            if ids and not (0 <= min(ids) and max(ids) < n):
+                raise ValueError('Process ids must be in range({})'.format(n))
+
+    def add_inputs(self, receiver_ids, sender_ids):
+        assert len(receiver_ids) == len(sender_ids)
+        self._check_ids(receiver_ids, sender_ids)
+        self._neighbours = None
+        self._input_rows.extend(receiver_ids)
+        self._input_columns.extend(sender_ids)
+
+    def add_outputs(self, sender_ids, receiver_ids):
+        assert len(sender_ids) == len(receiver_ids)
+        self._check_ids(sender_ids, receiver_ids)
+        self._neighbours = None
+        self._output_rows.extend(sender_ids)
+        self._output_columns.extend(receiver_ids)
+
+    def add_channels(self, sender_ids, receiver_ids):
+        # Both halves of each channel, which is what a matched register_outputs/register_inputs pair amounts to
+        self.add_outputs(sender_ids, receiver_ids)
+        self.add_inputs(receiver_ids, sender_ids)
+
+    def _keys(self, rows, columns):
+        n = len(self._processes)
+        return array('l', sorted(set(row * n + column for row, column in zip(rows, columns))))
+
+    def _describe(self, key):
+        n = len(self._processes)
+        return self._processes[key // n], self._processes[key % n]
+
+    def validate(self, input_keys=None, output_keys=None):
+        if input_keys is None:
+            input_keys = self._keys(self._input_rows, self._input_columns)
+        if output_keys is None:
+            output_keys = self._keys(self._output_rows, self._output_columns)
+        # Each input (receiver, sender) must be the transpose of an output (sender, receiver)
+        n = len(self._processes)
+        transposed = array('l', sorted((key % n) * n + key // n for key in input_keys))
+        if transposed == output_keys:
+            return
+        expected, declared = set(transposed), set(output_keys)
+        for key in sorted(expected - declared):
+            sender, process = self._describe(key)
+            raise AssertionError('{} expects input from {} but does not receive it'.format(process, sender))
+        for key in sorted(declared - expected):
+            process, output = self._describe(key)
+            raise AssertionError('{} outputs to {} but is not expected'.format(process, output))
+
+    def build(self):
+        input_keys = self._keys(self._input_rows, self._input_columns)
+        output_keys = self._keys(self._output_rows, self._output_columns)
+        self.validate(input_keys, output_keys)
+        return (CsrAdjacency.from_keys(self._processes, self._ids_by_process, input_keys),
+                CsrAdjacency.from_keys(self._processes, self._ids_by_process, output_keys))
+
+    def install(self, network):
+        process_inputs, process_outputs = self.build()
+        network.load_adjacency(self._processes, process_inputs, process_outputs)
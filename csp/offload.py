@@ -0,0 +1,111 @@
+import cPickle as pickle
+from Queue import Queue, Empty
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+
+def _call(function, args):
+    # Python 2 apply_async has no error callback, so failures come back as values. Exceptions from a process pool
+    # must be picklable to make the trip.
+    try:
+        return True, function(*args)
+    except Exception as e:
+        return False, e
+
+
+def _call_pickled(payload):
+    # For process pools, which drop a task whose arguments or result cannot be pickled without calling back. The
+    # call is pickled by submit, and the result here, where a failure can still be reported.
+    function, args = pickle.loads(payload)
+    succeeded, value = _call(function, args)
+    try:
+        return succeeded, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return False, pickle.dumps(pickle.PicklingError('Cannot return {!r}: {}'.format(value, e)),
+                                   pickle.HIGHEST_PROTOCOL)
+
+
+def _unpickled(result):
+    succeeded, data = result
+    try:
+        return succeeded, pickle.loads(data)
+    except Exception as e:
+        return False, e
+
+
+def run_inline(await_):
+    await_.origin_process.set_compute_result(*_call(await_.function, await_.args))
+
+
+class Offloader(object):
+    # Runs the functions of AwaitCompute commands in a pool while the controller keeps scheduling other processes.
+    # Pool callbacks arrive on a pool thread, so completions are queued and only handed to the network by poll(),
+    # from the controller's thread. A thread pool suits functions that release the GIL or block; CPU-bound pure
+    # Python wants processes, in which case the function and its arguments must be picklable.
+    def __init__(self, controller, workers=None, threads=False):
+        self._controller = controller
+
+        self._pool = (ThreadPool if threads else Pool)(workers)
+        self._pickled = not threads
+        self._completed = Queue()
+        self._pending = 0
+        self._wakeup = None
+
+        controller.set_offloader(self)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def set_wakeup(self, wakeup):
+        # Called from the pool thread after each completion is queued
+        self._wakeup = wakeup
+
+    def submit(self, await_):
+        self._pending += 1
+        if not self._pickled:
+            self._pool.apply_async(_call, (await_.function, await_.args),
+                                   callback=lambda result: self._finished(await_, result))
+            return
+        try:
+            payload = pickle.dumps((await_.function, await_.args), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            # Fails the await at once, rather than leaving it to a pool that would never answer
+            self._complete(await_, (False, e))
+            return
+        self._pool.apply_async(_call_pickled, (payload,),
+                               callback=lambda result: self._finished(await_, _unpickled(result)))
+
+    def _finished(self, await_, result):
+        self._completed.put((await_, result))
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def _complete(self, await_, result):
+        self._pending -= 1
+        await_.origin_process.set_compute_result(*result)
+        self._controller.add_ready(await_)
+
+    def poll(self):
+        completed = 0
+        while True:
+            try:
+                await_, result = self._completed.get_nowait()
+            except Empty:
+                return completed
+            self._complete(await_, result)
+            completed += 1
+
+    def wait(self, timeout=None):
+        # Block until at least one computation finishes, or the timeout passes
+        assert self._pending
+        try:
+            await_, result = self._completed.get(timeout=timeout)
+        except Empty:
+            return 0
+        self._complete(await_, result)
+        return 1 + self.poll()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -1,7 +1,10 @@
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, defaultdict, deque
 from copy import deepcopy
+from functools import partial
+from itertools import count
 
-from papers.csp.io_semantics import CommandFailure
+from papers.csp.io_semantics import CommandFailure, InputGuard, OutputGuard
 
 
 class Await(object):
@@ -30,10 +33,16 @@ class AwaitInput(Await):
     BRANCH_VALUE = 'BRANCH_VALUE'
     EITHER = 'EITHER'
 
-    def __init__(self, dest_process, guarded_matches, result_format=EITHER):
+    def __init__(self, dest_process, guarded_matches, result_format=EITHER, priority=False):
         self.dest_process = dest_process
-        self.guarded_matches = {input_guard: action for input_guard, action in guarded_matches.iteritems() if input_guard.viable}
+        if priority:
+            # Ordered (guard, action) pairs, highest priority first: the network takes the first that can proceed
+            self.guarded_matches = OrderedDict((input_guard, action) for input_guard, action in guarded_matches
+                                               if input_guard.viable)
+        else:
+            self.guarded_matches = {input_guard: action for input_guard, action in guarded_matches.iteritems() if input_guard.viable}
         self.result_format = result_format
+        self.priority = priority
 
     @property
     def origin_process(self):
@@ -60,7 +69,37 @@ class AwaitOutput(Await):
         return self.source_process
 
     def get_sending_value(self):
-        self.origin_process.output_done()
+        return None
+
+
+class AwaitCompute(Await):
+    def __init__(self, process, function, args):
+        self.process = process
+        self.function = function
+        self.args = args
+
+    @property
+    def origin_process(self):
+        return self.process
+
+    def get_sending_value(self):
+        return self.origin_process.get_compute_result()
+
+
+class AwaitIo(Await):
+    READ = 'READ'
+    WRITE = 'WRITE'
+
+    def __init__(self, process, fileobj, direction):
+        self.process = process
+        self.fd = fileobj if isinstance(fileobj, (int, long)) else fileobj.fileno()
+        self.direction = direction
+
+    @property
+    def origin_process(self):
+        return self.process
+
+    def get_sending_value(self):
         return None
 
 
@@ -70,16 +109,24 @@ class Process(object):
     def __init__(self, controller):
         super(Process, self).__init__()
         self._controller = controller
+        # Hashing by a per-controller serial rather than by address keeps dict and set iteration order, and so
+        # the schedule, reproducible from run to run
+        self._serial = controller.next_serial()
 
         self._callback = None
         self._branch_name = None
         self._input_value = None
+        self._taken_guard = None
+        self._compute_result = None
 
+        # Which await is pending is only checked by NaiveNetwork, from what the network has left for the process to
+        # resume with, so the protocol costs nothing here on a LeanNetwork
         self._running = False
-        self._awaiting_input = False
-        self._awaiting_output = False
         self._failed_await = False
 
+    def __hash__(self):
+        return self._serial
+
     @property
     def active(self):
         return self._controller.is_active(self)
@@ -92,10 +139,6 @@ class Process(object):
     def _callback_result_available(self):
         return self._callback is not None
 
-    @property
-    def _awaiting(self):
-        return self._awaiting_input or self._awaiting_output
-
     def register_inputs(self, *inputs):
         for input_ in inputs:
             self._controller.add_process_input(self, input_)
@@ -104,78 +147,100 @@ class Process(object):
         for output in outputs:
             self._controller.add_process_output(self, output)
 
-    def set_callback_input(self, callback, input_value):
-        assert self._awaiting_input
-        assert not self._callback_result_available
+    def declare_input(self, source_process, form):
+        self._controller.declare_channel(source_process, self, form)
+
+    def set_callback_input(self, callback, input_value, guard=None):
         self._callback = callback
         self._input_value = input_value
+        self._taken_guard = guard
 
-    def set_branch_value(self, branch_name, input_value):
-        assert self._awaiting_input
-        assert not self._branch_value_available
+    def set_branch_value(self, branch_name, input_value, guard=None):
         self._branch_name = branch_name
         self._input_value = input_value
+        self._taken_guard = guard
 
     def fail_await(self):
-        assert self._awaiting
         self._failed_await = True
 
+    @property
+    def failed_await(self):
+        return self._failed_await
+
+    @property
+    def taken_action(self):
+        # The action of the guard an alternation has taken, until the process is resumed with it
+        return self._callback if self._callback_result_available else self._branch_name
+
+    @property
+    def taken_guard(self):
+        # The guard itself, as several guards of an alternation may share an action
+        return self._taken_guard
+
+    @property
+    def has_compute_result(self):
+        return self._compute_result is not None
+
     def await_input(self, guarded_matches, result_format=AwaitInput.EITHER):
-        assert not self._awaiting
-        self._awaiting_input = True
         return AwaitInput(self, guarded_matches, result_format)
 
+    def await_priority_input(self, ordered_matches, result_format=AwaitInput.EITHER):
+        # Like await_input, but ordered_matches is a sequence of (guard, action) pairs, highest priority first
+        return AwaitInput(self, ordered_matches, result_format, priority=True)
+
     def await_output(self, process, value):
-        assert not self._awaiting
-        self._awaiting_output = True
         return AwaitOutput(self, process, value)
 
-    def get_input_callback_result(self):
-        assert self._awaiting_input
-        assert not self._failed_await
-        self._awaiting_input = False
+    def await_compute(self, function, *args):
+        # function(*args) runs outside the scheduler, so it should be pure; the process resumes with its result
+        return AwaitCompute(self, function, args)
+
+    def await_readable(self, fileobj):
+        # Resumes once a read from fileobj (a file descriptor or anything with fileno()) will not block
+        return AwaitIo(self, fileobj, AwaitIo.READ)
 
-        assert self._callback_result_available
+    def await_writable(self, fileobj):
+        return AwaitIo(self, fileobj, AwaitIo.WRITE)
+
+    def set_compute_result(self, succeeded, value):
+        self._compute_result = (succeeded, value)
+
+    def get_input_callback_result(self):
         callback, input_value = self._callback, self._input_value
         self._callback = None
         self._input_value = None
+        self._taken_guard = None
         return callback(input_value)
 
     def get_input_branch_value(self):
-        assert self._awaiting_input
-        assert not self._failed_await
-        self._awaiting_input = False
-
-        assert self._branch_value_available
         ret = (self._branch_name, self._input_value)
         self._branch_name = None
         self._input_value = None
+        self._taken_guard = None
         return ret
 
     def get_input_either(self):
-        assert self._callback_result_available ^ self._branch_value_available
         if self._callback_result_available:
             return None, self.get_input_callback_result()
         else:
             return self.get_input_branch_value()
 
-    def output_done(self):
-        assert self._awaiting_output
-        assert not self._failed_await
-        self._awaiting_output = False
+    def get_compute_result(self):
+        (succeeded, value), self._compute_result = self._compute_result, None
+        if not succeeded:
+            # Raised into the process at its yield, as an exception from inline code would have been
+            raise value
+        return value
 
     def check_failed_await(self):
         if not self._running:
             self._running = True
             return False
 
-        assert self._awaiting
         if not self._failed_await:
             return False
 
         self._failed_await = False
-        self._awaiting_input = False
-        self._awaiting_output = False
         return True
 
     @property
@@ -289,11 +354,30 @@ class SimpleAsyncWorkerProcess(Process):
         pass
 
 
+class Future(object):
+    def __init__(self, call_id, key, request):
+        self.call_id = call_id
+        self.key = key
+        self.request = request
+        self.sent = False
+        self.done = False
+        self.result = None
+
+    def __repr__(self):
+        return 'Future({}, {!r}, {!r}, done={})'.format(self.call_id, self.key, self.request, self.done)
+
+
 class AsyncCallerProcess(Process):
     def __init__(self, controller):
         super(AsyncCallerProcess, self).__init__(controller)
         self._workers = {}
 
+        # Pipelined calls: workers answer in the order they are asked, so replies are matched to requests per worker
+        self._call_ids = count()
+        self._unsent = defaultdict(deque)
+        self._in_flight = defaultdict(deque)
+        self._completed = deque()
+
     def get_worker(self, key):
         return self._workers[key]
 
@@ -306,6 +390,49 @@ class AsyncCallerProcess(Process):
     def _is_run_ready(self):
         return bool(self._workers)
 
+    def submit(self, key, request):
+        # Queues a request for the worker under key; await_progress() sends it and collects the reply
+        future = Future(next(self._call_ids), key, request)
+        self._unsent[key].append(future)
+        return future
+
+    @property
+    def pending_calls(self):
+        return sum(len(futures) for futures in self._unsent.itervalues()) + \
+            sum(len(futures) for futures in self._in_flight.itervalues())
+
+    def await_progress(self):
+        # One alternation over sending each worker its next request and receiving each outstanding reply, so no
+        # worker waits on the caller; yield it until the futures wanted are done
+        guarded_matches = {}
+        for key, futures in self._unsent.iteritems():
+            if futures:
+                guarded_matches[OutputGuard(self._workers[key], futures[0].request)] = partial(self._sent, key)
+        for key, futures in self._in_flight.iteritems():
+            if futures:
+                guarded_matches[InputGuard(self._workers[key])] = partial(self._received, key)
+        assert guarded_matches, 'No calls pending'
+        return self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+
+    def _sent(self, key, _):
+        future = self._unsent[key].popleft()
+        future.sent = True
+        self._in_flight[key].append(future)
+        return future
+
+    def _received(self, key, result):
+        future = self._in_flight[key].popleft()
+        future.result = result
+        future.done = True
+        self._completed.append(future)
+        return future
+
+    def completed(self):
+        # Futures finished since the last call, in the order their replies arrived
+        completed = list(self._completed)
+        self._completed.clear()
+        return completed
+
     @abstractmethod
     def _run(self):
         pass
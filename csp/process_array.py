@@ -0,0 +1,145 @@
+from papers.csp.io_semantics import InputGuard
+
+
+class ProcessArray(object):
+    # Hoare's X(i:1..n): n processes built from one definition and addressed by index. The definition and its
+    # constructor arguments are kept once for the array and shared by every element, and the elements are kept in
+    # one flat list. Elements get consecutive serials, so an element's position is its serial less the first one's
+    # and needs no per-element map, unless the definition makes processes of its own.
+    def __init__(self, controller, process_class, shape, *args, **kwargs):
+        if isinstance(shape, (int, long)):
+            shape = (shape,)
+        shape = tuple(shape)
+        assert shape and all(n > 0 for n in shape)
+        self._shape = shape
+
+        self._strides = []
+        size = 1
+        for n in reversed(shape):
+            self._strides.insert(0, size)
+            size *= n
+
+        self._process_class = process_class
+        self._args = args
+        self._kwargs = kwargs
+        self._processes = [process_class(controller, *args, **kwargs) for _ in xrange(size)]
+        self._first_serial = hash(self._processes[0])
+        self._positions = None
+        if any(hash(process) != self._first_serial + position for position, process in enumerate(self._processes)):
+            self._positions = {process: position for position, process in enumerate(self._processes)}
+
+    @property
+    def definition(self):
+        # (process_class, args, kwargs) every element was built from
+        return self._process_class, self._args, self._kwargs
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def __len__(self):
+        return len(self._processes)
+
+    def __iter__(self):
+        return iter(self._processes)
+
+    def _position(self, process):
+        if self._positions is not None:
+            return self._positions.get(process)
+        position = hash(process) - self._first_serial
+        if 0 <= position < len(self._processes) and self._processes[position] is process:
+            return position
+        return None
+
+    def __contains__(self, process):
+        return self._position(process) is not None
+
+    def __getitem__(self, index):
+        return self._processes[self._flatten(index)]
+
+    def _flatten(self, index):
+        if isinstance(index, (int, long)):
+            index = (index,)
+        assert len(index) == len(self._shape), 'Index {} does not match shape {}'.format(index, self._shape)
+        position = 0
+        for i, n, stride in zip(index, self._shape, self._strides):
+            if not 0 <= i < n:
+                raise IndexError('Index {} out of range for shape {}'.format(index, self._shape))
+            position += i * stride
+        return position
+
+    def _unflatten(self, position):
+        index = tuple((position // stride) % n for n, stride in zip(self._shape, self._strides))
+        return index[0] if len(index) == 1 else index
+
+    def indices(self):
+        for position in xrange(len(self._processes)):
+            yield self._unflatten(position)
+
+    def index(self, process):
+        position = self._position(process)
+        if position is None:
+            raise KeyError(process)
+        return self._unflatten(position)
+
+    def neighbour_index(self, index, offset, wrap=False):
+        # None if the neighbour falls off the edge of a non-wrapping array
+        if isinstance(index, (int, long)):
+            index = (index,)
+        if isinstance(offset, (int, long)):
+            offset = (offset,)
+        if len(index) != len(self._shape) or len(offset) != len(self._shape):
+            raise ValueError('Index {} and offset {} do not match shape {}'.format(index, offset, self._shape))
+        neighbour = []
+        for i, delta, n in zip(index, offset, self._shape):
+            j = i + delta
+            if wrap:
+                j %= n
+            elif not 0 <= j < n:
+                return None
+            neighbour.append(j)
+        return neighbour[0] if len(neighbour) == 1 else tuple(neighbour)
+
+    def neighbour(self, index, offset, wrap=False):
+        neighbour_index = self.neighbour_index(index, offset, wrap)
+        return None if neighbour_index is None else self[neighbour_index]
+
+    def pairs(self, offset, wrap=False):
+        for index in self.indices():
+            neighbour = self.neighbour(index, offset, wrap)
+            if neighbour is not None:
+                yield self[index], neighbour
+
+    def wire(self, offset, connect, wrap=False):
+        # connect(process, neighbour) does the wiring for each element and the element offset from it
+        for process, neighbour in self.pairs(offset, wrap):
+            connect(process, neighbour)
+
+    def chain(self, connect):
+        assert len(self._shape) == 1
+        self.wire(1, connect)
+
+    def ring(self, connect):
+        assert len(self._shape) == 1
+        self.wire(1, connect, wrap=True)
+
+    def grid(self, connect, wrap=False):
+        # Each element to its successor along every axis; a one-dimensional array is wired as a chain, or a ring
+        for axis in xrange(len(self._shape)):
+            self.wire(tuple(int(i == axis) for i in xrange(len(self._shape))), connect, wrap)
+
+    def input_guards(self, form=None, indices=None):
+        # Guards for (i:1..n) X(i)?v; a guard that fires gives the callback result (i, v)
+        if indices is None:
+            indices = self.indices()
+        return {InputGuard(self[index], form): _IndexedInput(index) for index in indices}
+
+
+class _IndexedInput(object):
+    __slots__ = ('_index',)
+
+    def __init__(self, index):
+        self._index = index
+
+    def __call__(self, value):
+        return self._index, value
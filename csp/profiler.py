@@ -0,0 +1,205 @@
+import sys
+import time
+from collections import Counter, defaultdict
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher, READY, BLOCKED_INPUT, \
+    BLOCKED_OUTPUT, WAITING
+from papers.csp.io_semantics import InputGuard, CommandFailure
+from papers.csp.process import SingleInputProcess, SingleOutputProcess, SingleInputOutputProcess
+
+
+# Finds the bottleneck of a running network by sampling what its processes are doing, rather than by counting
+# events: every so many steps the network is snapshotted, each process's state is tallied, and every blocked process
+# charges its wait to the ends of its wait chains, the processes it is transitively blocked on that are not blocked
+# themselves. The stage everyone is waiting for is the one charged most. A sample costs a pass over the active
+# processes and their peers, so the interval trades precision against overhead.
+
+def describe(process):
+    return '{}#{}'.format(type(process).__name__, hash(process))
+
+
+def _blocked(state):
+    return state is BLOCKED_INPUT or state is BLOCKED_OUTPUT
+
+
+def wait_roots(snapshot):
+    # process -> {root: share} for every blocked process in snapshot, with a blocked process dividing its wait evenly
+    # between its peers and on to their roots. Processes that are not blocked, and finished ones, are their own roots.
+    # A cycle of blocked processes charges no one for the part of the wait that goes round it. The dicts are shared
+    # along chains, so are not to be changed.
+    roots = {}
+
+    def roots_of(process):
+        found = roots.get(process)
+        if found is not None:
+            return found
+        state, peers = snapshot.get(process, (WAITING, ()))
+        if not _blocked(state) or not peers:
+            return {process: 1.0}
+        return {}
+
+    for start, (state, peers) in snapshot.iteritems():
+        if start in roots or not _blocked(state) or not peers:
+            continue
+        stack = [(start, iter(peers))]
+        on_stack = {start}
+        while stack:
+            process, pending = stack[-1]
+            descended = False
+            for peer in pending:
+                if peer in roots or peer in on_stack:
+                    continue
+                peer_state, peer_peers = snapshot.get(peer, (WAITING, ()))
+                if _blocked(peer_state) and peer_peers:
+                    stack.append((peer, iter(peer_peers)))
+                    on_stack.add(peer)
+                    descended = True
+                    break
+            if descended:
+                continue
+            stack.pop()
+            on_stack.discard(process)
+            _, peers = snapshot[process]
+            if len(peers) == 1:
+                roots[process] = roots_of(peers[0])
+                continue
+            share = 1.0 / len(peers)
+            combined = defaultdict(float)
+            for peer in peers:
+                for root, weight in roots_of(peer).iteritems():
+                    combined[root] += share * weight
+            roots[process] = combined
+    return roots
+
+
+class BlockingProfile(object):
+    def __init__(self):
+        self.samples = 0
+        # process -> state -> samples in that state
+        self.states = defaultdict(Counter)
+        # process -> peer -> samples spent blocked directly on it, shared between the peers of an alternation
+        self.blocked_on = defaultdict(Counter)
+        # root -> samples of other processes blocked on it through their wait chains
+        self.waited_on = Counter()
+
+    def add(self, snapshot):
+        self.samples += 1
+        for process, (state, peers) in snapshot.iteritems():
+            self.states[process][state] += 1
+            if not _blocked(state) or not peers:
+                continue
+            blocked_on = self.blocked_on[process]
+            share = 1.0 / len(peers)
+            for peer in peers:
+                blocked_on[peer] += share
+        for roots in wait_roots(snapshot).itervalues():
+            for root, weight in roots.iteritems():
+                self.waited_on[root] += weight
+
+    def ratios(self, process):
+        # state -> fraction of the samples process was seen in, while it was active
+        states = self.states[process]
+        seen = sum(states.itervalues())
+        return {state: float(count) / seen for state, count in states.iteritems()} if seen else {}
+
+    def bottleneck(self):
+        # (process, share of all blocked samples spent waiting on it), or None if nothing was ever blocked
+        if not self.waited_on:
+            return None
+        process, waited = self.waited_on.most_common(1)[0]
+        return process, waited / sum(self.waited_on.itervalues())
+
+    def report(self, top=10, out=None):
+        out = out or sys.stdout
+        out.write('{} samples\n'.format(self.samples))
+        total = sum(self.waited_on.itervalues())
+        for process, waited in self.waited_on.most_common(top):
+            ratios = self.ratios(process)
+            out.write('{:>24}: {:5.1%} of waits, ready {:5.1%} in {:5.1%} out {:5.1%} waiting {:5.1%}\n'.format(
+                describe(process), waited / total, ratios.get(READY, 0.0), ratios.get(BLOCKED_INPUT, 0.0),
+                ratios.get(BLOCKED_OUTPUT, 0.0), ratios.get(WAITING, 0.0)))
+        bottleneck = self.bottleneck()
+        if bottleneck is not None:
+            out.write('Bottleneck: {}, {:.1%} of waits\n'.format(describe(bottleneck[0]), bottleneck[1]))
+
+
+def profile(controller, every=None, max_steps=None, deadline=None, blocking_profile=None):
+    # Runs a wired controller as Controller.run does, in slices of every steps with a sample between each, and
+    # returns (finished, profile). By default a slice is ten steps per active process, which keeps sampling to a few
+    # percent of the run. Samples are only taken between slices, so a run shorter than a slice has none.
+    blocking_profile = blocking_profile or BlockingProfile()
+    network = controller.network
+    stop = None if max_steps is None else controller.steps + max_steps
+    while True:
+        steps = every or max(10 * network.num_active, 100)
+        if stop is not None:
+            steps = min(steps, stop - controller.steps)
+        if controller.run(max_steps=steps, deadline=deadline):
+            return True, blocking_profile
+        blocking_profile.add(network.snapshot())
+        if stop is not None and controller.steps >= stop:
+            return False, blocking_profile
+        if deadline is not None and time.time() >= deadline:
+            return False, blocking_profile
+
+
+def _increment(value):
+    return value + 1
+
+
+class Produce(SingleOutputProcess):
+    def __init__(self, controller, items):
+        super(Produce, self).__init__(controller)
+        self._items = items
+
+    def _run(self):
+        for item in xrange(self._items):
+            yield self.await_output(self._output_process, item)
+
+
+class Stage(SingleInputOutputProcess):
+    # Takes work computations per item, each a step of its own
+    def __init__(self, controller, work=1):
+        super(Stage, self).__init__(controller)
+        self._work = work
+
+    def _run(self):
+        while True:
+            try:
+                _, value = yield self.await_input({InputGuard(self._input_process): 'item'})
+            except CommandFailure:
+                break
+            for _ in xrange(self._work):
+                value = yield self.await_compute(_increment, value)
+            yield self.await_output(self._output_process, value)
+
+
+class Consume(SingleInputProcess):
+    def _run(self):
+        while True:
+            try:
+                yield self.await_input({InputGuard(self._input_process): 'item'})
+            except CommandFailure:
+                break
+
+
+def run(stages=20, slow_stage=5, work=10, items=2000):
+    # A pipeline with one stage doing more work per item than the rest: the stages before it are blocked sending to
+    # it, those after are blocked waiting on it, and the profile should say so
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    previous = Produce(controller, items)
+    for i in range(stages):
+        stage = Stage(controller, work if i == slow_stage else 1)
+        previous.set_output(stage)
+        stage.set_input(previous)
+        previous = stage
+    consume = Consume(controller)
+    previous.set_output(consume)
+    consume.set_input(previous)
+    controller.wire()
+
+    _, blocking_profile = profile(controller)
+    blocking_profile.report(top=5)
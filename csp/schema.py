@@ -0,0 +1,76 @@
+import struct
+
+from papers.csp.io_semantics import NTuple, Signal
+
+
+class Schema(object):
+    # A channel's message type with a fixed binary layout. form is what the channel is declared to carry, as for an
+    # InputGuard, and fmt the struct format of its fields: a tuple form is packed field by field, a Signal has no
+    # fields and anything else is packed as a single field. Without a byte order in fmt, little endian and no
+    # padding are used, so records are the same on every host.
+    def __init__(self, form, fmt):
+        assert form is not None
+        if fmt[:1] not in ('@', '=', '<', '>', '!'):
+            fmt = '<' + fmt
+        self._form = form
+        self._struct = struct.Struct(fmt)
+        if isinstance(form, NTuple):
+            assert form.length == self._fields_in(fmt)
+        elif issubclass(form, Signal):
+            assert self._fields_in(fmt) == 0
+
+    @staticmethod
+    def _fields_in(fmt):
+        return len(struct.unpack(fmt, '\0' * struct.calcsize(fmt)))
+
+    @property
+    def form(self):
+        return self._form
+
+    @property
+    def size(self):
+        return self._struct.size
+
+    def _fields(self, value):
+        if isinstance(self._form, NTuple) or issubclass(self._form, tuple):
+            return value
+        if issubclass(self._form, Signal):
+            return ()
+        return value,
+
+    def _value(self, fields):
+        if isinstance(self._form, NTuple) or self._form is tuple:
+            return fields
+        if hasattr(self._form, '_make'):
+            return self._form._make(fields)
+        if issubclass(self._form, Signal):
+            return self._form()
+        value, = fields
+        return value
+
+    def pack(self, value):
+        return self._struct.pack(*self._fields(value))
+
+    def pack_into(self, buffer_, offset, value):
+        self._struct.pack_into(buffer_, offset, *self._fields(value))
+
+    def unpack(self, data):
+        return self._value(self._struct.unpack(data))
+
+    def unpack_from(self, buffer_, offset=0):
+        return self._value(self._struct.unpack_from(buffer_, offset))
+
+    def pack_all(self, values):
+        values = list(values)
+        buffer_ = bytearray(self.size * len(values))
+        for index, value in enumerate(values):
+            self.pack_into(buffer_, index * self.size, value)
+        return buffer_
+
+    def unpack_all(self, data):
+        assert len(data) % self.size == 0
+        for offset in xrange(0, len(data), self.size):
+            yield self.unpack_from(data, offset)
+
+    def __repr__(self):
+        return 'Schema({}, {!r})'.format(getattr(self._form, '__name__', self._form), self._struct.format)
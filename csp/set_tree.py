@@ -0,0 +1,190 @@
+import random
+from bisect import bisect_right
+from timeit import default_timer
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.exercises import Has45, Insert45, Least46, NoneLeft44, Ex45Runner, Ex46Runner, build_ex_4_5, \
+    build_ex_4_6
+from papers.csp.io_semantics import InputGuard, CommandFailure
+from papers.csp.process import Process
+
+
+class SetTreeNode(Process):
+    # Covers the keys [lo, hi) and routes each request to the child whose range holds its key, so a request takes
+    # one hop per level. Least46 is asked of the children in key order, skipping those known to be empty.
+    def __init__(self, controller, lo, hi):
+        super(SetTreeNode, self).__init__(controller)
+        self._lo = lo
+        self._hi = hi
+        self._parent_process = None
+        self._children = []
+        self._bounds = []
+
+    def set_parent_process(self, parent_process):
+        assert self._parent_process is None
+        self.register_inputs(parent_process)
+        self.register_outputs(parent_process)
+        self._parent_process = parent_process
+
+    def add_child(self, child, lo):
+        # Children are added in key order, each with the lowest key it covers
+        assert not self._bounds or lo > self._bounds[-1]
+        self.register_outputs(child)
+        self.register_inputs(child)
+        self._children.append(child)
+        self._bounds.append(lo)
+
+    def _is_run_ready(self):
+        return self._parent_process is not None and self._children
+
+    def _route(self, n):
+        # Keys outside the tree's range go to the nearest end
+        return max(bisect_right(self._bounds, n) - 1, 0)
+
+    def _run(self):
+        maybe_nonempty = [False] * len(self._children)
+        guarded_matches = {InputGuard(self._parent_process, Has45): 'has',
+                           InputGuard(self._parent_process, Insert45): 'insert',
+                           InputGuard(self._parent_process, Least46): 'least'}
+        while True:
+            try:
+                branch, value = yield self.await_input(guarded_matches)
+                if branch != 'least':
+                    index = self._route(value.n)
+                    if branch == 'insert':
+                        maybe_nonempty[index] = True
+                    yield self.await_output(self._children[index], value)
+                    continue
+
+                assert branch == 'least'
+                least = NoneLeft44()
+                for index, child in enumerate(self._children):
+                    if not maybe_nonempty[index]:
+                        continue
+                    yield self.await_output(child, value)
+                    branch, child_least = yield self.await_input({InputGuard(child, int): 'least',
+                                                                  InputGuard(child, NoneLeft44): 'none_left'})
+                    if branch == 'least':
+                        least = child_least
+                        break
+                    maybe_nonempty[index] = False
+                yield self.await_output(self._parent_process, least)
+            except CommandFailure:
+                break
+
+
+class SetTreeLeaf(Process):
+    # Holds the members of a small key range and answers Has45 straight to the originating process, as the
+    # chain's workers do
+    def __init__(self, controller, lo, hi):
+        super(SetTreeLeaf, self).__init__(controller)
+        self._lo = lo
+        self._hi = hi
+        self._parent_process = None
+        self._originating_process = None
+
+    def set_parent_process(self, parent_process):
+        assert self._parent_process is None
+        self.register_inputs(parent_process)
+        self.register_outputs(parent_process)
+        self._parent_process = parent_process
+
+    def set_originating_process(self, originating_process):
+        assert self._originating_process is None
+        self.register_outputs(originating_process)
+        self._originating_process = originating_process
+
+    def _is_run_ready(self):
+        return self._parent_process is not None and self._originating_process is not None
+
+    def _run(self):
+        members = set()
+        guarded_matches = {InputGuard(self._parent_process, Has45): 'has',
+                           InputGuard(self._parent_process, Insert45): 'insert',
+                           InputGuard(self._parent_process, Least46): 'least'}
+        while True:
+            try:
+                branch, value = yield self.await_input(guarded_matches)
+                if branch == 'has':
+                    yield self.await_output(self._originating_process, value.n in members)
+                elif branch == 'insert':
+                    members.add(value.n)
+                else:
+                    assert branch == 'least'
+                    if not members:
+                        yield self.await_output(self._parent_process, NoneLeft44())
+                        continue
+                    least = min(members)
+                    members.remove(least)
+                    yield self.await_output(self._parent_process, least)
+            except CommandFailure:
+                break
+
+
+def build_set_tree(controller, runner, lo, hi, leaf_size=8, fanout=2):
+    # A balanced tree over the keys [lo, hi) with leaves of about leaf_size keys, under runner, which must be an
+    # Ex45Runner or Ex46Runner
+    assert hi > lo and leaf_size > 0 and fanout > 1
+
+    def build(parent, lo, hi):
+        if hi - lo <= leaf_size:
+            node = SetTreeLeaf(controller, lo, hi)
+            node.set_originating_process(runner)
+            runner.add_response_process(node)
+        else:
+            node = SetTreeNode(controller, lo, hi)
+            step = -(-(hi - lo) // fanout)
+            for child_lo in xrange(lo, hi, step):
+                child = build(node, child_lo, min(child_lo + step, hi))
+                node.add_child(child, child_lo)
+        node.set_parent_process(parent)
+        return node
+
+    root = build(runner, lo, hi)
+    runner.set_receiver_process(root)
+    # The root answers Least46 to its parent; Ex45Runner never asks, but the channel is declared either way
+    runner.register_inputs(root)
+    return root
+
+
+def run(size=32, universe=1000):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+
+    runner = Ex46Runner(controller, random.sample(range(universe), size))
+    build_set_tree(controller, runner, 0, universe)
+
+    controller.wire()
+    controller.run()
+
+    print 'Ran to completion'
+
+
+def _measure(build):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+    build(controller)
+    controller.wire()
+    start = default_timer()
+    controller.run()
+    return controller.steps, default_timer() - start
+
+
+def benchmark(sizes=(16, 64, 256), least=False, seed=0):
+    # Steps and seconds for the same inputs against the chain and the tree. The chain gets one spare worker,
+    # since a full chain passes Least46 on to its FailProcess.
+    for size in sizes:
+        random.seed(seed)
+        universe = 4 * size
+        inputs = random.sample(range(universe), size)
+        runner_class, build_chain = (Ex46Runner, build_ex_4_6) if least else (Ex45Runner, build_ex_4_5)
+
+        random.seed(seed)
+        chain_steps, chain_time = _measure(lambda controller: build_chain(controller, inputs, size + 1))
+        random.seed(seed)
+        tree_steps, tree_time = _measure(
+            lambda controller: build_set_tree(controller, runner_class(controller, inputs), 0, universe))
+        print('size {}: chain {} steps {:.3f}s, tree {} steps {:.3f}s'.format(
+            size, chain_steps, chain_time, tree_steps, tree_time))
@@ -0,0 +1,135 @@
+import random
+from collections import deque
+from functools import partial
+
+from papers.csp.controller import Controller, SequentialDispatcher, NaiveNetwork
+from papers.csp.exercises import Has43, Insert43, Scan44, Next44, NoneLeft44, Set44, Ex44Runner
+from papers.csp.io_semantics import InputGuard, OutputGuard, CommandFailure
+from papers.csp.process import SimpleAsyncWorkerProcess, AwaitInput
+
+
+class ShardRouter(SimpleAsyncWorkerProcess):
+    # Looks like a single Set44 to its caller, but partitions the members by hash across Set44 shards, so capacity
+    # grows with the number of shards. Has43 and Insert43 go to the owning shard without waiting on earlier
+    # queries, and answers go back in the order asked; Scan44 waits for those to drain, then scans every shard at
+    # once and passes on their members as they arrive.
+    def __init__(self, controller):
+        super(ShardRouter, self).__init__(controller)
+        self._shards = []
+
+    @property
+    def shards(self):
+        return tuple(self._shards)
+
+    def add_shard(self, process):
+        self._shards.append(process)
+        self.register_inputs(process)
+        self.register_outputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return self._caller_process is not None and bool(self._shards)
+
+    def _owner(self, n):
+        return hash(n) % len(self._shards)
+
+    def _run(self):
+        outboxes = [deque() for _ in self._shards]
+        owed = [0] * len(self._shards)
+        answers = [deque() for _ in self._shards]
+        # The shard owing each unanswered Has43, oldest first
+        pending = deque()
+        scan = []
+
+        def route(value):
+            index = self._owner(value.n)
+            outboxes[index].append(value)
+            if isinstance(value, Has43):
+                pending.append(index)
+
+        def sent(index, _):
+            if isinstance(outboxes[index].popleft(), Has43):
+                owed[index] += 1
+
+        def received(index, value):
+            owed[index] -= 1
+            answers[index].append(value)
+
+        def replied(_):
+            answers[pending.popleft()].popleft()
+
+        def scanned(shard, value):
+            return shard, value
+
+        while True:
+            if scan and not pending and not any(outboxes):
+                del scan[:]
+                try:
+                    # Every shard is idle here, so each takes its Scan44 at once
+                    for shard in self._shards:
+                        yield self.await_output(shard, Scan44())
+
+                    scanning = set(self._shards)
+                    while scanning:
+                        scan_matches = {}
+                        for shard in scanning:
+                            scan_matches[InputGuard(shard, Next44)] = partial(scanned, shard)
+                            scan_matches[InputGuard(shard, NoneLeft44)] = partial(scanned, shard)
+                        shard, value = yield self.await_input(scan_matches, AwaitInput.CALLBACK_RESULT)
+                        if isinstance(value, NoneLeft44):
+                            scanning.remove(shard)
+                            continue
+                        yield self.await_output(self._caller_process, value)
+                    yield self.await_output(self._caller_process, NoneLeft44())
+                except CommandFailure:
+                    break
+                continue
+
+            guarded_matches = {}
+            if not scan:
+                guarded_matches[InputGuard(self._caller_process, Has43)] = route
+                guarded_matches[InputGuard(self._caller_process, Insert43)] = route
+                guarded_matches[InputGuard(self._caller_process, Scan44)] = scan.append
+            if pending and answers[pending[0]]:
+                guarded_matches[OutputGuard(self._caller_process, answers[pending[0]][0])] = replied
+            for index, shard in enumerate(self._shards):
+                if outboxes[index]:
+                    guarded_matches[OutputGuard(shard, outboxes[index][0])] = partial(sent, index)
+                if owed[index]:
+                    guarded_matches[InputGuard(shard)] = partial(received, index)
+
+            if not any(guard.viable for guard in guarded_matches) and not pending:
+                # The caller has gone and nothing is owed to it, so the shards can be let go
+                break
+            try:
+                yield self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+            except CommandFailure:
+                break
+
+
+def build_sharded_set(controller, caller, num_shards=4):
+    router = ShardRouter(controller)
+    router.set_caller(caller)
+    for _ in range(num_shards):
+        shard = Set44(controller)
+        shard.set_caller(router)
+        router.add_shard(shard)
+    return router
+
+
+def run(size=300, num_shards=4):
+    # More members than a single Set44 can hold
+    test_set = set(random.sample(range(4 * size), size))
+
+    controller = Controller()
+    SequentialDispatcher(controller)
+    NaiveNetwork(controller)
+
+    runner = Ex44Runner(controller, test_set)
+    router = build_sharded_set(controller, runner, num_shards)
+    runner.set_worker('set', router)
+
+    controller.wire()
+    controller.run()
+
+    print 'Ran to completion'
@@ -0,0 +1,259 @@
+import math
+import random
+import resource
+from collections import deque, namedtuple
+from multiprocessing import Pool
+from timeit import default_timer
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.io_semantics import InputGuard, OutputGuard, CommandFailure
+from papers.csp.process import Process, AwaitInput
+
+
+# Synthetic topologies for finding how the runtime scales. Messages are injected by Sources and hop from Node to
+# Node until they run out of hops or reach a node without outputs, where they are delivered. Nodes buffer what they
+# receive, so cyclic topologies cannot deadlock, and runs stop once every message has been delivered rather than
+# when the processes finish.
+
+Message = namedtuple('Message', ['hops_left', 'payload'])
+
+Measurement = namedtuple('Measurement', ['topology', 'size', 'processes', 'messages', 'steps', 'seconds',
+                                         'messages_per_second', 'steps_per_second', 'rss_kb'])
+
+
+class Tally(object):
+    def __init__(self):
+        self.delivered = 0
+
+
+class Source(Process):
+    def __init__(self, controller, messages, payload_size, hops):
+        super(Source, self).__init__(controller)
+        self._messages = messages
+        self._payload_size = payload_size
+        self._hops = hops
+        self._outputs = []
+
+    def add_output(self, process):
+        self._outputs.append(process)
+        self.register_outputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return bool(self._outputs)
+
+    def _run(self):
+        for i in xrange(self._messages):
+            output = self._outputs[i % len(self._outputs)]
+            try:
+                yield self.await_output(output, Message(self._hops, bytearray(self._payload_size)))
+            except CommandFailure:
+                break
+
+
+class Node(Process):
+    # Forwards to its outputs in turn, or delivers to the tally when it has none or the message has no hops left
+    def __init__(self, controller, tally):
+        super(Node, self).__init__(controller)
+        self._tally = tally
+        self._inputs = []
+        self._outputs = []
+
+    def add_input(self, process):
+        self._inputs.append(process)
+        self.register_inputs(process)
+
+    def add_output(self, process):
+        self._outputs.append(process)
+        self.register_outputs(process)
+
+    @property
+    def _is_run_ready(self):
+        return bool(self._inputs)
+
+    def _run(self):
+        buffered = deque()
+        next_output = [0]
+
+        def received(message):
+            if not self._outputs or not message.hops_left:
+                self._tally.delivered += 1
+            else:
+                buffered.append(message._replace(hops_left=message.hops_left - 1))
+
+        def sent(_):
+            buffered.popleft()
+            next_output[0] = (next_output[0] + 1) % len(self._outputs)
+
+        input_matches = {InputGuard(process): received for process in self._inputs}
+        while True:
+            guarded_matches = dict(input_matches)
+            if buffered:
+                guarded_matches[OutputGuard(self._outputs[next_output[0]], buffered[0])] = sent
+            try:
+                yield self.await_input(guarded_matches, AwaitInput.CALLBACK_RESULT)
+            except CommandFailure:
+                break
+
+
+def _connect(sender, receiver):
+    sender.add_output(receiver)
+    receiver.add_input(sender)
+
+
+def _nodes(controller, tally, size):
+    return [Node(controller, tally) for _ in xrange(size)]
+
+
+def pipeline(controller, tally, size, source):
+    nodes = _nodes(controller, tally, size)
+    _connect(source, nodes[0])
+    for node, next_ in zip(nodes, nodes[1:]):
+        _connect(node, next_)
+    return nodes
+
+
+def ring(controller, tally, size, source):
+    # Messages go once round, to be delivered by the node before the one they entered at
+    nodes = _nodes(controller, tally, size)
+    _connect(source, nodes[0])
+    for i, node in enumerate(nodes):
+        _connect(node, nodes[(i + 1) % size])
+    return nodes
+
+
+def binary_tree(controller, tally, size, source):
+    # Leaves deliver
+    nodes = _nodes(controller, tally, size)
+    _connect(source, nodes[0])
+    for i in xrange(1, size):
+        _connect(nodes[(i - 1) // 2], nodes[i])
+    return nodes
+
+
+def fan_out(controller, tally, size, source):
+    # A hub dealing to size - 1 leaves
+    nodes = _nodes(controller, tally, size)
+    _connect(source, nodes[0])
+    for leaf in nodes[1:]:
+        _connect(nodes[0], leaf)
+    return nodes
+
+
+def fan_in(controller, tally, size, source):
+    # size - 1 spokes, each fed by the source, all into one hub which delivers
+    nodes = _nodes(controller, tally, size)
+    for spoke in nodes[1:]:
+        _connect(source, spoke)
+        _connect(spoke, nodes[0])
+    return nodes
+
+
+def random_sparse(controller, tally, size, source, degree=2):
+    # A cycle through every node, so each has an input, and degree - 1 more random successors per node; messages
+    # are delivered when their hops run out
+    nodes = _nodes(controller, tally, size)
+    _connect(source, nodes[0])
+    for i, node in enumerate(nodes):
+        successor = (i + 1) % size
+        _connect(node, nodes[successor])
+        others = [j for j in xrange(size) if j != i and j != successor]
+        for j in random.sample(others, min(degree - 1, len(others))):
+            _connect(node, nodes[j])
+    return nodes
+
+
+def grid(controller, tally, size, source):
+    # side x side, flowing right and down to the far corner, which delivers
+    side = max(int(math.sqrt(size)), 1)
+    nodes = _nodes(controller, tally, side * side)
+    _connect(source, nodes[0])
+    for row in xrange(side):
+        for column in xrange(side):
+            node = nodes[row * side + column]
+            if column + 1 < side:
+                _connect(node, nodes[row * side + column + 1])
+            if row + 1 < side:
+                _connect(node, nodes[(row + 1) * side + column])
+    return nodes
+
+
+TOPOLOGIES = {
+    'pipeline': pipeline,
+    'ring': ring,
+    'binary_tree': binary_tree,
+    'fan_out': fan_out,
+    'fan_in': fan_in,
+    'random_sparse': random_sparse,
+    'grid': grid,
+}
+
+
+def _rss_kb():
+    # Current resident set size where /proc has it. Otherwise the lifetime peak, which only grows across a run in a
+    # process that has not already used more, e.g. a fresh worker as scaling uses.
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(topology, size, messages=1000, payload_size=64, network_class=NaiveNetwork, seed=0):
+    # rss_kb is how much resident memory grew over the run, taken while the network is still alive
+    random.seed(seed)
+    rss_before = _rss_kb()
+    controller = Controller()
+    network_class(controller)
+    SequentialDispatcher(controller)
+
+    tally = Tally()
+    # Enough hops to cross any of the topologies, and to go once round a ring
+    source = Source(controller, messages, payload_size, size - 1)
+    nodes = TOPOLOGIES[topology](controller, tally, size, source)
+    controller.wire()
+
+    start = default_timer()
+    controller.run_until(lambda: tally.delivered >= messages)
+    seconds = default_timer() - start
+    rss_after = _rss_kb()
+    return Measurement(topology, size, len(nodes) + 1, messages, controller.steps, seconds,
+                       messages / seconds if seconds else 0.0, controller.steps / seconds if seconds else 0.0,
+                       rss_after - rss_before)
+
+
+def _measure_task(args):
+    topology, size, params = args
+    return measure(topology, size, **dict(params))
+
+
+def _exponent(previous, current, field):
+    # Fitted power of size between two measurements: about 1 for linear growth
+    ratio = float(getattr(current, field)) / getattr(previous, field) if getattr(previous, field) else 0.0
+    if ratio <= 0 or current.size == previous.size:
+        return float('nan')
+    return math.log(ratio) / math.log(float(current.size) / previous.size)
+
+
+def scaling(topologies=sorted(TOPOLOGIES), sizes=(16, 64, 256, 1024), **params):
+    # Each measurement runs in a fresh worker process, so memory left over from earlier runs is not counted.
+    # Time per step should stay flat as size grows; an exponent well above 1 for steps, seconds or memory is
+    # superlinear behaviour.
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        for topology in topologies:
+            previous = None
+            for size in sizes:
+                result = pool.apply(_measure_task, ((topology, size, sorted(params.items())),))
+                line = '{:>13} {:>6}: {:>8} steps {:>8.3f}s {:>9.0f} msg/s {:>9.0f} steps/s {:>8} KB'.format(
+                    topology, size, result.steps, result.seconds, result.messages_per_second,
+                    result.steps_per_second, result.rss_kb)
+                if previous is not None:
+                    line += '  exponents: steps {:.2f} seconds {:.2f} memory {:.2f}'.format(
+                        _exponent(previous, result, 'steps'), _exponent(previous, result, 'seconds'),
+                        _exponent(previous, result, 'rss_kb'))
+                print(line)
+                previous = result
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,272 @@
+import math
+import time
+from itertools import count
+
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.io_semantics import InputGuard, TimeoutGuard, CommandFailure
+from papers.csp.process import SingleOutputProcess, SingleInputProcess
+
+
+class RealClock(object):
+    virtual = False
+
+    def now(self):
+        return time.time()
+
+    def sleep_until(self, deadline):
+        delay = deadline - self.now()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VirtualClock(object):
+    # Time only moves when the controller has nothing else to do, and then straight to the next deadline
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def sleep_until(self, deadline):
+        self._now = max(self._now, deadline)
+
+
+class _Timer(object):
+    __slots__ = ('tick', 'callback', 'serial', 'level', 'slot')
+
+    def __init__(self, tick, callback, serial):
+        self.tick = tick
+        self.callback = callback
+        self.serial = serial
+        self.level = None
+        # The set the timer currently sits in, so cancelling is a single removal
+        self.slot = None
+
+    def __hash__(self):
+        return self.serial
+
+
+class TimerWheel(object):
+    # Hierarchical timing wheel over integer ticks. Level l has 2 ** BITS slots, each 2 ** (BITS * l) ticks wide,
+    # and holds the timers that share every higher digit of their tick with the current tick; timers beyond the
+    # top level wait in an overflow set. Scheduling and cancelling are O(1). Advancing expires level 0 slot by
+    # slot and cascades a higher slot down as the current tick enters it, jumping over runs of empty levels.
+    BITS = 6
+    LEVELS = 4
+
+    def __init__(self, tick=0):
+        self._size = 1 << self.BITS
+        self._mask = self._size - 1
+        self._levels = [[set() for _ in xrange(self._size)] for _ in xrange(self.LEVELS)]
+        self._counts = [0] * self.LEVELS
+        self._overflow = set()
+        self._tick = tick
+        self._serials = count()
+
+    @property
+    def tick(self):
+        return self._tick
+
+    def __len__(self):
+        return sum(self._counts) + len(self._overflow)
+
+    def _level(self, tick):
+        difference = tick ^ self._tick
+        for level in xrange(self.LEVELS):
+            if difference >> (self.BITS * (level + 1)) == 0:
+                return level
+        return None
+
+    def _place(self, timer):
+        level = timer.level = self._level(timer.tick)
+        if level is None:
+            timer.slot = self._overflow
+        else:
+            timer.slot = self._levels[level][(timer.tick >> (self.BITS * level)) & self._mask]
+            self._counts[level] += 1
+        timer.slot.add(timer)
+
+    def _remove(self, timer):
+        timer.slot.remove(timer)
+        if timer.level is not None:
+            self._counts[timer.level] -= 1
+        timer.slot = None
+
+    def schedule(self, tick, callback):
+        # Ticks already passed expire on the next advance
+        timer = _Timer(max(tick, self._tick), callback, next(self._serials))
+        self._place(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            self._remove(timer)
+
+    def _cascade(self):
+        # Called as the tick lands on a slot boundary: redistribute the slots it has entered, highest first
+        if self._tick % (1 << (self.BITS * self.LEVELS)) == 0:
+            for timer in list(self._overflow):
+                self._remove(timer)
+                self._place(timer)
+        for level in xrange(self.LEVELS - 1, 0, -1):
+            if self._tick % (1 << (self.BITS * level)):
+                continue
+            slot = self._levels[level][(self._tick >> (self.BITS * level)) & self._mask]
+            for timer in list(slot):
+                self._remove(timer)
+                self._place(timer)
+
+    def advance(self, tick):
+        # Moves the wheel to tick and returns the timers due by then, ordered by tick then by scheduling
+        expired = []
+        while self._tick <= tick:
+            if self._counts[0]:
+                slot = self._levels[0][self._tick & self._mask]
+                for timer in slot:
+                    timer.slot = None
+                self._counts[0] -= len(slot)
+                expired.extend(slot)
+                slot.clear()
+                if self._tick == tick:
+                    break
+                self._tick += 1
+            else:
+                # Nothing can be due before the next boundary of the lowest occupied level
+                level = next((level for level in xrange(1, self.LEVELS) if self._counts[level]), self.LEVELS)
+                width = 1 << (self.BITS * level)
+                boundary = (self._tick // width + 1) * width
+                if not len(self) or boundary > tick:
+                    self._tick = tick
+                    break
+                self._tick = boundary
+            if self._tick & self._mask == 0:
+                self._cascade()
+        expired.sort(key=lambda timer: (timer.tick, timer.serial))
+        return expired
+
+    def next_tick(self):
+        # The earliest tick with a timer due, or None
+        for level in xrange(self.LEVELS):
+            if not self._counts[level]:
+                continue
+            slots = self._levels[level]
+            for index in xrange((self._tick >> (self.BITS * level)) & self._mask, self._size):
+                if slots[index]:
+                    return min(timer.tick for timer in slots[index])
+        if self._overflow:
+            return min(timer.tick for timer in self._overflow)
+        return None
+
+
+class Timers(object):
+    # Deadlines for the controller, kept in a TimerWheel at the given resolution in seconds. With a VirtualClock
+    # the controller jumps straight to the next deadline when nothing is ready, so timed simulations run as fast
+    # as the processes do.
+    def __init__(self, controller, clock=None, resolution=0.001):
+        self._controller = controller
+        self._clock = RealClock() if clock is None else clock
+        self._resolution = resolution
+        self._wheel = TimerWheel(self._to_tick(self._clock.now()))
+
+        controller.set_timers(self)
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def virtual(self):
+        return self._clock.virtual
+
+    @property
+    def pending(self):
+        return len(self._wheel)
+
+    def now(self):
+        return self._clock.now()
+
+    def _to_tick(self, seconds):
+        # Rounded up, so a timer never fires before its deadline, but not by float error alone
+        return int(math.ceil(seconds / self._resolution - 1e-6))
+
+    def schedule(self, delay, callback):
+        return self._wheel.schedule(self._to_tick(self._clock.now() + delay), callback)
+
+    def cancel(self, timer):
+        self._wheel.cancel(timer)
+
+    def next_deadline(self):
+        tick = self._wheel.next_tick()
+        return None if tick is None else tick * self._resolution
+
+    def time_to_next(self):
+        deadline = self.next_deadline()
+        return None if deadline is None else max(0.0, deadline - self._clock.now())
+
+    def _fire(self, tick):
+        expired = self._wheel.advance(tick)
+        for timer in expired:
+            timer.callback()
+        return len(expired)
+
+    def _now_tick(self):
+        return int(math.floor(self._clock.now() / self._resolution + 1e-6))
+
+    def poll(self):
+        return self._fire(max(self._wheel.tick, self._now_tick()))
+
+    def wait(self):
+        # Sleep (or, on a virtual clock, jump) until the next deadline and fire what is due
+        tick = self._wheel.next_tick()
+        assert tick is not None
+        self._clock.sleep_until(tick * self._resolution)
+        return self._fire(max(tick, self._now_tick()))
+
+
+class Sleeper(SingleOutputProcess):
+    # Sends each delay after sleeping for it, using an alternation with nothing but a timeout
+    def __init__(self, controller, delays):
+        super(Sleeper, self).__init__(controller)
+        self._delays = delays
+
+    def _run(self):
+        for delay in self._delays:
+            yield self.await_input({TimeoutGuard(delay): 'slept'})
+            yield self.await_output(self._output_process, delay)
+
+
+class Watchdog(SingleInputProcess):
+    def __init__(self, controller, patience):
+        super(Watchdog, self).__init__(controller)
+        self._patience = patience
+
+    def _run(self):
+        clock = self._controller.timers.clock
+        # The timeout would keep the alternation alive after the input has gone, so stop with the input
+        while self._input_process.active:
+            try:
+                branch, value = yield self.await_input({InputGuard(self._input_process): 'input',
+                                                        TimeoutGuard(self._patience): 'timeout'})
+            except CommandFailure:
+                break
+            if branch == 'timeout':
+                print('{:.3f}: nothing for {}s'.format(clock.now(), self._patience))
+            else:
+                print('{:.3f}: got {}'.format(clock.now(), value))
+
+
+def run(virtual=True, patience=1.0):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+    Timers(controller, VirtualClock() if virtual else None)
+
+    sleeper = Sleeper(controller, [0.5, 2.5, 0.1, 1.5])
+    watchdog = Watchdog(controller, patience)
+    sleeper.set_output(watchdog)
+    watchdog.set_input(sleeper)
+
+    controller.wire()
+    controller.run()
@@ -0,0 +1,197 @@
+import json
+from timeit import default_timer
+
+from papers.csp import eratosthenes
+from papers.csp.controller import Controller, NaiveNetwork, SequentialDispatcher
+from papers.csp.io_semantics import OutputGuard, TimeoutGuard
+from papers.csp.process import AwaitInput, AwaitOutput
+from papers.csp.profiler import describe
+
+
+# Records what the processes of a run did into a ring buffer, for viewing as per-process timelines in chrome://tracing
+# or Perfetto. The tracer hooks in by shadowing methods of a controller's dispatcher and network with wrappers on
+# those instances, so the classes are untouched and a controller it is not installed on pays nothing. Once the
+# buffer is full the oldest events are overwritten.
+
+RUN = 'run'
+SEND = 'send'
+RECEIVE = 'receive'
+ALTERNATION = 'alternation'
+WAIT = 'wait'
+RENDEZVOUS = 'rendezvous'
+TIMEOUT = 'timeout'
+FAILURE = 'failure'
+TERMINATION = 'termination'
+
+
+def _posted_kind(await_input):
+    # An alternation of only output guards is sending, one of only input guards receiving, and one of only
+    # timeouts waiting
+    has_input = has_output = False
+    for guard in await_input.guarded_matches:
+        if isinstance(guard, OutputGuard):
+            has_output = True
+        elif not isinstance(guard, TimeoutGuard):
+            has_input = True
+    if has_output and not has_input:
+        return SEND
+    if has_input and not has_output:
+        return RECEIVE
+    return ALTERNATION if has_input else WAIT
+
+
+class Tracer(object):
+    def __init__(self, capacity=100000):
+        assert capacity > 0
+        self._capacity = capacity
+        # (start, duration or None, kind, pid, process, peer)
+        self._events = [None] * capacity
+        self._recorded = [0]
+        self._start = default_timer()
+        # (instance, attribute) for every wrapper installed
+        self._installed = []
+
+    @property
+    def recorded(self):
+        return self._recorded[0]
+
+    @property
+    def dropped(self):
+        return max(self._recorded[0] - self._capacity, 0)
+
+    def _recorder(self):
+        events, recorded, capacity = self._events, self._recorded, self._capacity
+
+        def record(start, duration, kind, pid, process, peer=None):
+            events[recorded[0] % capacity] = start, duration, kind, pid, process, peer
+            recorded[0] += 1
+        return record
+
+    def _wrap(self, instance, attribute, wrapper_factory):
+        # The wrapper goes in the instance's dict, ahead of the class's method
+        assert attribute not in vars(instance), '{} already has {} wrapped'.format(instance, attribute)
+        setattr(instance, attribute, wrapper_factory(getattr(instance, attribute)))
+        self._installed.append((instance, attribute))
+
+    def install(self, controller, pid=0):
+        # Traces a controller with its dispatcher and network in place; pid tells controllers apart, such as the
+        # inner controllers of composites, when one tracer is installed on several
+        record = self._recorder()
+        clock = default_timer
+        dispatcher, network = controller.dispatcher, controller.network
+        chosen = [None]
+
+        def wrap_choose(choose):
+            def traced_choose(ready_awaits):
+                await_ = choose(ready_awaits)
+                chosen[0] = await_.origin_process
+                return await_
+            return traced_choose
+
+        def wrap_run_one(run_one):
+            def traced_run_one(ready_awaits):
+                start = clock()
+                try:
+                    return run_one(ready_awaits)
+                finally:
+                    record(start, clock() - start, RUN, pid, chosen[0])
+            return traced_run_one
+
+        def wrap_await(await_):
+            def traced_await(posted):
+                if isinstance(posted, AwaitOutput):
+                    record(clock(), None, SEND, pid, posted.source_process, posted.dest_process)
+                elif isinstance(posted, AwaitInput):
+                    record(clock(), None, _posted_kind(posted), pid, posted.dest_process)
+                return await_(posted)
+            return traced_await
+
+        def wrap_add_ready(add_ready):
+            # Every send and alternation ends here, whether it completed at once, after blocking or by failing. An
+            # alternation's outcome is that of the guard it took, and its peer that guard's partner.
+            def traced_add_ready(ready):
+                if isinstance(ready, AwaitOutput):
+                    process = ready.origin_process
+                    record(clock(), None, FAILURE if process.failed_await else RENDEZVOUS, pid, process,
+                           ready.dest_process)
+                elif isinstance(ready, AwaitInput):
+                    process = ready.origin_process
+                    guard = None if process.failed_await else process.taken_guard
+                    if guard is None:
+                        record(clock(), None, FAILURE, pid, process)
+                    elif isinstance(guard, TimeoutGuard):
+                        record(clock(), None, TIMEOUT, pid, process)
+                    else:
+                        peer = guard.dest_process if isinstance(guard, OutputGuard) else guard.source_process
+                        record(clock(), None, RENDEZVOUS, pid, process, peer)
+                return add_ready(ready)
+            return traced_add_ready
+
+        def wrap_deactivate_process(deactivate_process):
+            def traced_deactivate_process(process):
+                record(clock(), None, TERMINATION, pid, process)
+                return deactivate_process(process)
+            return traced_deactivate_process
+
+        self._wrap(dispatcher, '_choose', wrap_choose)
+        self._wrap(dispatcher, 'run_one', wrap_run_one)
+        self._wrap(network, 'await_', wrap_await)
+        self._wrap(network, 'add_ready', wrap_add_ready)
+        self._wrap(network, 'deactivate_process', wrap_deactivate_process)
+
+    def uninstall(self):
+        for instance, attribute in reversed(self._installed):
+            delattr(instance, attribute)
+        del self._installed[:]
+
+    def events(self):
+        # The buffered events, oldest first
+        recorded = self._recorded[0]
+        if recorded <= self._capacity:
+            return self._events[:recorded]
+        split = recorded % self._capacity
+        return self._events[split:] + self._events[:split]
+
+    def chrome_trace(self):
+        # The Chrome trace event format: a thread per process, runs as complete events and the rest as instants
+        trace_events = []
+        threads = {}
+        for start, duration, kind, pid, process, peer in self.events():
+            if process is None:
+                continue
+            tid = hash(process)
+            threads[(pid, tid)] = process
+            event = {'name': kind, 'pid': pid, 'tid': tid, 'ts': (start - self._start) * 1e6}
+            if duration is None:
+                event['ph'] = 'i'
+                event['s'] = 't'
+            else:
+                event['ph'] = 'X'
+                event['dur'] = duration * 1e6
+            if peer is not None:
+                event['args'] = {'peer': describe(peer)}
+            trace_events.append(event)
+        for (pid, tid), process in sorted(threads.iteritems()):
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                                 'args': {'name': describe(process)}})
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def export(self, fileobj):
+        json.dump(self.chrome_trace(), fileobj)
+
+
+def run(path='eratosthenes_trace.json', sieves=25, limit=100):
+    controller = Controller()
+    NaiveNetwork(controller)
+    SequentialDispatcher(controller)
+    eratosthenes.build(controller, sieves, limit)
+    controller.wire()
+
+    tracer = Tracer()
+    tracer.install(controller)
+    controller.run()
+    tracer.uninstall()
+
+    with open(path, 'w') as fileobj:
+        tracer.export(fileobj)
+    print('{} events written to {}'.format(tracer.recorded, path))